@@ -22,6 +22,8 @@ def register():
         AccountTemplate,
         Account,
         AccountDeferral,
+        AccountPeriodBalance,
+        AccountPartyBalance,
         OpenChartAccountStart,
         PrintGeneralLedgerStart,
         PrintTrialBalanceStart,
@@ -3,10 +3,10 @@
 from decimal import Decimal
 import datetime
 import operator
-from itertools import izip, groupby
+import zlib
 from sql import Column, Literal
 from sql.aggregate import Sum
-from sql.conditionals import Coalesce
+from sql.conditionals import Coalesce, Case
 
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import Wizard, StateView, StateAction, StateTransition, \
@@ -16,10 +16,15 @@ from trytond.tools import reduce_ids
 from trytond.pyson import Eval, PYSONEncoder, Date
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.cache import Cache
 from trytond import backend
 
+from .common import get_tree, rollup, cache_get, cache_set, cache_clear
+
 __all__ = ['TypeTemplate', 'Type', 'OpenType', 'AccountTemplate', 'Account',
-    'AccountDeferral', 'OpenChartAccountStart', 'OpenChartAccount',
+    'AccountDeferral', 'AccountPeriodBalance', 'AccountPartyBalance',
+    'OpenChartAccountStart',
+    'OpenChartAccount',
     'PrintGeneralLedgerStart', 'PrintGeneralLedger', 'GeneralLedger',
     'PrintTrialBalanceStart', 'PrintTrialBalance', 'TrialBalance',
     'OpenBalanceSheetStart', 'OpenBalanceSheet',
@@ -236,12 +241,9 @@ class Type(ModelSQL, ModelView):
         Account = pool.get('account.account')
 
         res = {}
-        for type_ in types:
-            res[type_.id] = Decimal('0.0')
-
-        childs = cls.search([
-                ('parent', 'child_of', [t.id for t in types]),
-                ])
+        # The types can not be inactive, only their inactive accounts are
+        # excluded by the search
+        childs = get_tree(cls, [t.id for t in types])
         type_sum = {}
         for type_ in childs:
             type_sum[type_.id] = Decimal('0.0')
@@ -252,14 +254,10 @@ class Type(ModelSQL, ModelView):
                 ])
         for account in accounts:
             type_sum[account.type.id] += (account.debit - account.credit)
+        type_sum = rollup(childs, type_sum)
 
         for type_ in types:
-            childs = cls.search([
-                    ('parent', 'child_of', [type_.id]),
-                    ])
-            for child in childs:
-                res[type_.id] += type_sum[child.id]
-            res[type_.id] = type_.company.currency.round(res[type_.id])
+            res[type_.id] = type_.company.currency.round(type_sum[type_.id])
             if type_.display_balance == 'credit-debit':
                 res[type_.id] = - res[type_.id]
         return res
@@ -641,40 +639,41 @@ class Account(ModelSQL, ModelView):
     def get_balance(cls, accounts, name):
         pool = Pool()
         MoveLine = pool.get('account.move.line')
+        PeriodBalance = pool.get('account.account.period_balance')
         FiscalYear = pool.get('account.fiscalyear')
         cursor = Transaction().cursor
         in_max = cursor.IN_MAX
 
-        table_a = cls.__table__()
-        table_c = cls.__table__()
-        line = MoveLine.__table__()
-        ids = [a.id for a in accounts]
-        balances = dict((i, 0) for i in ids)
-        line_query, fiscalyear_ids = MoveLine.query_get(line)
-        for i in range(0, len(ids), in_max):
-            sub_ids = ids[i:i + in_max]
-            red_sql = reduce_ids(table_a.id, sub_ids)
-            cursor.execute(*table_a.join(table_c,
-                    condition=(table_c.left >= table_a.left)
-                    & (table_c.right <= table_a.right)
-                    ).join(line, condition=line.account == table_c.id
-                    ).select(
-                    table_a.id,
-                    Sum(Coalesce(line.debit, 0) - Coalesce(line.credit, 0)),
-                    where=red_sql & line_query & table_c.active,
-                    group_by=table_a.id))
-            result = cursor.fetchall()
-            balances.update(dict(result))
-
-        # SQLite uses float for SUM
-        for account_id, balance in balances.iteritems():
-            if isinstance(balance, Decimal):
-                break
-            balances[account_id] = Decimal(str(balance))
-
+        # Aggregate only once per account and sum up the parents in Python
+        # instead of re-aggregating the descendants of each account.
+        childs = get_tree(cls, [a.id for a in accounts])
+        child_ids = [c.id for c in childs if c.active]
+        source = PeriodBalance.__table__()
+        query, fiscalyear_ids = PeriodBalance.query_get(source)
+        if query is None:
+            source = MoveLine.__table__()
+            query, fiscalyear_ids = MoveLine.query_get(source)
+        child_balances = {}
+        for i in range(0, len(child_ids), in_max):
+            sub_ids = child_ids[i:i + in_max]
+            red_sql = reduce_ids(source.account, sub_ids)
+            cursor.execute(*source.select(
+                    source.account,
+                    Sum(Coalesce(source.debit, 0)
+                        - Coalesce(source.credit, 0)),
+                    where=red_sql & query,
+                    group_by=source.account))
+            for account_id, balance in cursor.fetchall():
+                # SQLite uses float for SUM
+                if not isinstance(balance, Decimal):
+                    balance = Decimal(str(balance))
+                child_balances[account_id] = balance
+        child_balances = rollup(childs, child_balances)
+
+        balances = {}
         for account in accounts:
             balances[account.id] = account.company.currency.round(
-                balances[account.id])
+                child_balances[account.id])
 
         fiscalyears = FiscalYear.browse(fiscalyear_ids)
         func = lambda accounts, names: \
@@ -691,6 +690,7 @@ class Account(ModelSQL, ModelView):
         '''
         pool = Pool()
         MoveLine = pool.get('account.move.line')
+        PeriodBalance = pool.get('account.account.period_balance')
         FiscalYear = pool.get('account.fiscalyear')
         cursor = Transaction().cursor
         in_max = cursor.IN_MAX
@@ -703,18 +703,24 @@ class Account(ModelSQL, ModelView):
             result[name] = dict((i, 0) for i in ids)
 
         table = cls.__table__()
-        line = MoveLine.__table__()
-        line_query, fiscalyear_ids = MoveLine.query_get(line)
+        source = PeriodBalance.__table__()
+        query, fiscalyear_ids = PeriodBalance.query_get(source)
+        if query is not None:
+            from_ = table.join(source, 'LEFT',
+                condition=source.account == table.id)
+        else:
+            source = MoveLine.__table__()
+            from_ = table.join(source, 'LEFT',
+                condition=source.account == table.id)
+            query, fiscalyear_ids = MoveLine.query_get(source)
         columns = [table.id]
         for name in names:
-            columns.append(Sum(Coalesce(Column(line, name), 0)))
+            columns.append(Sum(Coalesce(Column(source, name), 0)))
         for i in range(0, len(ids), in_max):
             sub_ids = ids[i:i + in_max]
             red_sql = reduce_ids(table.id, sub_ids)
-            cursor.execute(*table.join(line, 'LEFT',
-                    condition=line.account == table.id
-                    ).select(*columns,
-                    where=red_sql & line_query,
+            cursor.execute(*from_.select(*columns,
+                    where=red_sql & query,
                     group_by=table.id))
             for row in cursor.fetchall():
                 account_id = row[0]
@@ -745,7 +751,6 @@ class Account(ModelSQL, ModelView):
         pool = Pool()
         FiscalYear = pool.get('account.fiscalyear')
         Deferral = pool.get('account.account.deferral')
-        in_max = Transaction().cursor.IN_MAX
         names = values.keys()
 
         youngest_fiscalyear = None
@@ -768,22 +773,12 @@ class Account(ModelSQL, ModelView):
             return values
 
         if fiscalyear.state == 'close':
-            id2deferral = {}
-            ids = [a.id for a in accounts]
-            for i in range(0, len(ids), in_max):
-                sub_ids = ids[i:i + in_max]
-                deferrals = Deferral.search([
-                    ('fiscalyear', '=', fiscalyear.id),
-                    ('account', 'in', sub_ids),
-                    ])
-                for deferral in deferrals:
-                    id2deferral[deferral.account.id] = deferral
-
+            id2deferral = Deferral.get_cumulate(fiscalyear)
             for account in accounts:
                 if account.id in id2deferral:
                     deferral = id2deferral[account.id]
                     for name in names:
-                        values[name][account.id] += getattr(deferral, name)
+                        values[name][account.id] += deferral[name]
         else:
             with Transaction().set_context(fiscalyear=fiscalyear.id,
                     date=None, periods=None):
@@ -960,6 +955,8 @@ class AccountDeferral(ModelSQL, ModelView):
             depends=['currency_digits']), 'get_balance')
     currency_digits = fields.Function(fields.Integer('Currency Digits'),
             'get_currency_digits')
+    _cumulate_cache = Cache('account_account_deferral.cumulate',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -992,6 +989,359 @@ class AccountDeferral(ModelSQL, ModelView):
     def write(cls, deferrals, values, *args):
         cls.raise_user_error('write_deferral')
 
+    @classmethod
+    def create(cls, vlist):
+        cache_clear(cls._cumulate_cache)
+        return super(AccountDeferral, cls).create(vlist)
+
+    @classmethod
+    def delete(cls, deferrals):
+        cache_clear(cls._cumulate_cache)
+        super(AccountDeferral, cls).delete(deferrals)
+
+    @classmethod
+    def get_cumulate(cls, fiscalyear):
+        '''
+        Return for each account id a dictionary with the debit, credit and
+        balance deferred by the closed fiscal year.
+        The result is cached until the deferrals are created or deleted.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        key = (fiscalyear.company.id, fiscalyear.id)
+        result = cache_get(cls._cumulate_cache, key)
+        if result is not None:
+            return result
+
+        result = {}
+        cursor.execute(*table.select(table.account, table.debit, table.credit,
+                where=table.fiscalyear == fiscalyear.id))
+        for account_id, debit, credit in cursor.fetchall():
+            # SQLite uses float for NUMERIC
+            if not isinstance(debit, Decimal):
+                debit = Decimal(str(debit))
+            if not isinstance(credit, Decimal):
+                credit = Decimal(str(credit))
+            result[account_id] = {
+                'debit': debit,
+                'credit': credit,
+                'balance': debit - credit,
+                }
+        cache_set(cls._cumulate_cache, key, result)
+        return result
+
+
+class BalanceMixin(object):
+    '''
+    Mixin for the tables storing the debit/credit of the move lines by key.
+    The key is made of the balance columns without debit and credit.
+    '''
+
+    @classmethod
+    def get_amounts(cls, moves):
+        '''
+        Return the amounts of the lines of the moves as a dictionary with the
+        key as key and (debit, credit) as value.
+        '''
+        cursor = Transaction().cursor
+        amounts = {}
+        move_ids = list(set(m.id for m in moves))
+        for i in range(0, len(move_ids), cursor.IN_MAX):
+            sub_ids = move_ids[i:i + cursor.IN_MAX]
+            where = lambda line, move: reduce_ids(move.id, sub_ids)
+            cursor.execute(*cls._get_balance_query(where))
+            for row in cursor.fetchall():
+                key = row[:-3] + (bool(row[-3]),)
+                # SQLite uses float for SUM
+                debit, credit = [a if isinstance(a, Decimal)
+                    else Decimal(str(a)) for a in row[-2:]]
+                old_debit, old_credit = amounts.get(key, (0, 0))
+                amounts[key] = (old_debit + debit, old_credit + credit)
+        return amounts
+
+    @classmethod
+    def lock_keys(cls, keys):
+        '''
+        Lock the balances of the keys until the end of the transaction.
+        PostgreSQL uses advisory locks, the other backends lock the table.
+        '''
+        cursor = Transaction().cursor
+        if backend.name() == 'postgresql':
+            name_key = zlib.crc32(cls.__name__) & 0x7fffffff
+            # Always lock in the same order to prevent dead locks
+            for key in sorted(set(zlib.crc32(repr(k)) & 0x7fffffff
+                        for k in keys)):
+                cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                    (name_key, key))
+        else:
+            cls.lock()
+
+    @classmethod
+    def update(cls, old, new):
+        '''
+        Add to the balances the difference between the new and the old
+        amounts as returned by get_amounts.
+        The keys are locked so concurrent updates wait for each other instead
+        of inserting the same key twice.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        columns = cls._get_balance_columns(table)
+        key_columns = columns[:-2]
+
+        deltas = {}
+        for key in set(old) | set(new):
+            old_debit, old_credit = old.get(key, (0, 0))
+            debit, credit = new.get(key, (0, 0))
+            if debit != old_debit or credit != old_credit:
+                deltas[key] = (debit - old_debit, credit - old_credit)
+        if not deltas:
+            return
+        cls.lock_keys(deltas.keys())
+
+        for key, (debit, credit) in deltas.iteritems():
+            where = Literal(True)
+            for column, value in zip(key_columns, key):
+                where &= column == value
+            cursor.execute(*table.update(
+                    columns=[table.debit, table.credit],
+                    values=[table.debit + debit, table.credit + credit],
+                    where=where))
+            if not cursor.rowcount:
+                cursor.execute(*table.insert(columns=columns,
+                        values=[list(key) + [debit, credit]]))
+            # The balances without lines are removed
+            cursor.execute(*table.delete(
+                    where=where & (table.debit == 0) & (table.credit == 0)))
+
+
+class AccountPeriodBalance(BalanceMixin, ModelSQL):
+    '''
+    Account Period Balance
+
+    It stores the debit/credit of the valid move lines by account, period and
+    move state. It is maintained by the move lines.
+    '''
+    __name__ = 'account.account.period_balance'
+    account = fields.Many2One('account.account', 'Account', required=True,
+        ondelete='CASCADE', select=True)
+    period = fields.Many2One('account.period', 'Period', required=True,
+        ondelete='CASCADE', select=True)
+    posted = fields.Boolean('Posted')
+    debit = fields.Numeric('Debit', required=True)
+    credit = fields.Numeric('Credit', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AccountPeriodBalance, cls).__setup__()
+        cls._sql_constraints += [
+            ('account_period_posted_uniq', 'UNIQUE(account, period, posted)',
+                'The balance must be unique by account, period and state.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(AccountPeriodBalance, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['account', 'period'], 'add')
+
+        # Migration from 3.0: fill the balances from the existing lines
+        MoveLine = Pool().get('account.move.line')
+        if created and TableHandler.table_exist(cursor, MoveLine._table):
+            table = cls.__table__()
+            cursor.execute(*table.insert(
+                    columns=cls._get_balance_columns(table),
+                    values=cls._get_balance_query()))
+
+    @staticmethod
+    def default_posted():
+        return False
+
+    @staticmethod
+    def default_debit():
+        return Decimal(0)
+
+    @staticmethod
+    def default_credit():
+        return Decimal(0)
+
+    @staticmethod
+    def _get_balance_columns(table):
+        return [table.account, table.period, table.posted, table.debit,
+            table.credit]
+
+    @classmethod
+    def _get_balance_query(cls, where=None):
+        '''
+        Return the SQL query computing the balances of the move lines.
+        where is the SQL clause on the account.move.line and account.move
+        tables used to restrict the lines.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+
+        condition = line.state != 'draft'
+        if where is not None:
+            condition &= where(line, move)
+        query = line.join(move, condition=line.move == move.id
+            ).select(line.account.as_('account'),
+                move.period.as_('period'),
+                (move.state == 'posted').as_('posted'),
+                Coalesce(line.debit, 0).as_('debit'),
+                Coalesce(line.credit, 0).as_('credit'),
+                where=condition)
+        return query.select(query.account, query.period, query.posted,
+            Sum(query.debit), Sum(query.credit),
+            group_by=[query.account, query.period, query.posted])
+
+    @classmethod
+    def query_get(cls, table):
+        '''
+        Return SQL clause and fiscal years for account period balance
+        depending of the context.
+        It returns None as clause if the context can not be computed per
+        period, in which case the move lines must be used.
+        table is the SQL instance of a table with period and posted columns
+        '''
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Period = pool.get('account.period')
+        period = Period.__table__()
+
+        if Transaction().context.get('date'):
+            return None, None
+
+        if Transaction().context.get('posted'):
+            posted_clause = table.posted
+        else:
+            posted_clause = Literal(True)
+
+        if Transaction().context.get('periods'):
+            if Transaction().context.get('fiscalyear'):
+                fiscalyear_ids = [Transaction().context['fiscalyear']]
+            else:
+                fiscalyear_ids = []
+            return (table.period.in_(Transaction().context['periods'])
+                & posted_clause, fiscalyear_ids)
+        else:
+            if not Transaction().context.get('fiscalyear'):
+                fiscalyears = FiscalYear.search([
+                    ('state', '=', 'open'),
+                    ])
+                fiscalyear_ids = [f.id for f in fiscalyears] or [0]
+            else:
+                fiscalyear_ids = [Transaction().context.get('fiscalyear')]
+            return (table.period.in_(period.select(period.id,
+                        where=period.fiscalyear.in_(fiscalyear_ids)))
+                & posted_clause, fiscalyear_ids)
+
+
+class AccountPartyBalance(BalanceMixin, ModelSQL):
+    '''
+    Account Party Balance
+
+    It stores the debit/credit of the unreconciled valid move lines by party,
+    account, period and move state. It is maintained by the move lines.
+    '''
+    __name__ = 'account.account.party_balance'
+    party = fields.Many2One('party.party', 'Party', required=True,
+        ondelete='CASCADE', select=True)
+    account = fields.Many2One('account.account', 'Account', required=True,
+        ondelete='CASCADE', select=True)
+    period = fields.Many2One('account.period', 'Period', required=True,
+        ondelete='CASCADE', select=True)
+    posted = fields.Boolean('Posted')
+    debit = fields.Numeric('Debit', required=True)
+    credit = fields.Numeric('Credit', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AccountPartyBalance, cls).__setup__()
+        cls._sql_constraints += [
+            ('party_account_period_posted_uniq',
+                'UNIQUE(party, account, period, posted)',
+                'The balance must be unique by party, account, period and '
+                'state.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(AccountPartyBalance, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['party', 'account'], 'add')
+        table.index_action(['account', 'period'], 'add')
+
+        # Migration from 3.0: fill the balances from the existing lines
+        MoveLine = Pool().get('account.move.line')
+        if created and TableHandler.table_exist(cursor, MoveLine._table):
+            table = cls.__table__()
+            cursor.execute(*table.insert(
+                    columns=cls._get_balance_columns(table),
+                    values=cls._get_balance_query()))
+
+    @staticmethod
+    def default_posted():
+        return False
+
+    @staticmethod
+    def default_debit():
+        return Decimal(0)
+
+    @staticmethod
+    def default_credit():
+        return Decimal(0)
+
+    @staticmethod
+    def _get_balance_columns(table):
+        return [table.party, table.account, table.period, table.posted,
+            table.debit, table.credit]
+
+    @classmethod
+    def _get_balance_query(cls, where=None):
+        '''
+        Return the SQL query computing the balances of the unreconciled move
+        lines with a party.
+        where is the SQL clause on the account.move.line and account.move
+        tables used to restrict the lines.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+
+        condition = ((line.state != 'draft')
+            & (line.party != None)
+            & (line.reconciliation == None))
+        if where is not None:
+            condition &= where(line, move)
+        query = line.join(move, condition=line.move == move.id
+            ).select(line.party.as_('party'),
+                line.account.as_('account'),
+                move.period.as_('period'),
+                (move.state == 'posted').as_('posted'),
+                Coalesce(line.debit, 0).as_('debit'),
+                Coalesce(line.credit, 0).as_('credit'),
+                where=condition)
+        return query.select(query.party, query.account, query.period,
+            query.posted, Sum(query.debit), Sum(query.credit),
+            group_by=[query.party, query.account, query.period,
+                query.posted])
+
 
 class OpenChartAccountStart(ModelView):
     'Open Chart of Accounts'
@@ -1178,70 +1528,131 @@ class GeneralLedger(Report):
         localcontext['end_period'] = periods[-1]
 
         if not data['empty_account']:
-            account2lines = dict(cls.get_lines(accounts,
-                    end_periods, data['posted']))
+            account_ids = cls.get_account_ids(accounts, end_periods,
+                data['posted'])
             accounts = Account.browse([a.id for a in accounts
-                    if a in account2lines])
+                    if a.id in account_ids])
 
-        account_id2lines = cls.lines(accounts,
-            list(set(end_periods).difference(set(start_periods))),
-            data['posted'])
+        periods = list(set(end_periods).difference(set(start_periods)))
 
         localcontext['accounts'] = accounts
         localcontext['id2start_account'] = id2start_account
         localcontext['id2end_account'] = id2end_account
         localcontext['digits'] = company.currency.digits
-        localcontext['lines'] = lambda account_id: account_id2lines[account_id]
+        localcontext['lines'] = lambda account_id: cls.lines(account_id,
+            periods, data['posted'])
         localcontext['company'] = company
 
         return super(GeneralLedger, cls).parse(report, objects, data,
             localcontext)
 
     @classmethod
-    def get_lines(cls, accounts, periods, posted):
-        MoveLine = Pool().get('account.move.line')
-        clause = [
-            ('account', 'in', [a.id for a in accounts]),
-            ('period', 'in', [p.id for p in periods]),
-            ('state', '!=', 'draft'),
-            ]
+    def _get_lines_where(cls, line, move, periods, posted):
+        where = (move.period.in_([p.id for p in periods] or [None])
+            & (line.state != 'draft'))
         if posted:
-            clause.append(('move.state', '=', 'posted'))
-        lines = MoveLine.search(clause,
-            order=[
-                ('account', 'ASC'),
-                ('date', 'ASC'),
-                ])
-        return groupby(lines, operator.attrgetter('account'))
+            where &= move.state == 'posted'
+        return where
+
+    @classmethod
+    def get_account_ids(cls, accounts, periods, posted):
+        'Return the set of account ids having lines in the periods'
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        cursor = Transaction().cursor
+        in_max = cursor.IN_MAX
+        line = MoveLine.__table__()
+        move = Move.__table__()
+
+        account_ids = set()
+        ids = [a.id for a in accounts]
+        where = cls._get_lines_where(line, move, periods, posted)
+        for i in range(0, len(ids), in_max):
+            sub_ids = ids[i:i + in_max]
+            cursor.execute(*line.join(move, condition=line.move == move.id
+                    ).select(line.account,
+                    where=reduce_ids(line.account, sub_ids) & where,
+                    group_by=line.account))
+            account_ids.update(a for a, in cursor.fetchall())
+        return account_ids
 
     @classmethod
-    def lines(cls, accounts, periods, posted):
-        Move = Pool().get('account.move')
-        res = dict((a.id, []) for a in accounts)
-        account2lines = cls.get_lines(accounts, periods, posted)
+    def lines(cls, account_id, periods, posted, batch_size=1000):
+        '''
+        Yield the values of the lines of the account in the periods ordered by
+        date with the running balance.
+        The lines are read by batch of batch_size using the last date and id
+        as starting point, so the memory used does not depend on the number of
+        lines and the cursor stays free between the batches.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        cursor = Transaction().cursor
+        line = MoveLine.__table__()
+        move = Move.__table__()
 
         state_selections = dict(Move.fields_get(
                 fields_names=['state'])['state']['selection'])
 
-        for account, lines in account2lines:
-            balance = Decimal('0.0')
-            for line in lines:
-                balance += line.debit - line.credit
-                res[account.id].append({
-                        'date': line.date,
-                        'move': line.move.rec_name,
-                        'debit': line.debit,
-                        'credit': line.credit,
-                        'balance': balance,
-                        'description': '\n'.join(
-                            (line.move.description or '',
-                                line.description or '')).strip(),
-                        'origin': (line.move.origin.rec_name
-                            if line.move.origin else ''),
-                        'state': state_selections.get(line.move.state,
-                            line.move.state),
-                        })
-        return res
+        where = ((line.account == account_id)
+            & cls._get_lines_where(line, move, periods, posted))
+        balance = Decimal('0.0')
+        last = None
+        while True:
+            batch_where = where
+            if last:
+                last_id, last_date = last
+                batch_where &= ((move.date > last_date)
+                    | ((move.date == last_date) & (line.id > last_id)))
+            cursor.execute(*line.join(move, condition=line.move == move.id
+                    ).select(line.id, move.date, move.number, line.debit,
+                    line.credit, move.description, line.description,
+                    move.origin, move.state,
+                    where=batch_where,
+                    order_by=[move.date.asc, line.id.asc],
+                    limit=batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last = rows[-1][:2]
+
+            origins = {}
+            for row in rows:
+                if not row[7]:
+                    continue
+                model, origin_id = row[7].split(',')
+                if int(origin_id) >= 0:
+                    origins.setdefault(model, set()).add(int(origin_id))
+            origin2name = {}
+            for model, origin_ids in origins.iteritems():
+                Model = pool.get(model)
+                for origin in Model.browse(list(origin_ids)):
+                    origin2name['%s,%s' % (model, origin.id)] = \
+                        origin.rec_name
+
+            for (_, date, number, debit, credit, move_description,
+                    description, origin, state) in rows:
+                # SQLite uses float for NUMERIC
+                if not isinstance(debit, Decimal):
+                    debit = Decimal(str(debit))
+                if not isinstance(credit, Decimal):
+                    credit = Decimal(str(credit))
+                balance += debit - credit
+                yield {
+                    'date': date,
+                    'move': number,
+                    'debit': debit,
+                    'credit': credit,
+                    'balance': balance,
+                    'description': '\n'.join(
+                        (move_description or '', description or '')).strip(),
+                    'origin': origin2name.get(origin, ''),
+                    'state': state_selections.get(state, state),
+                    }
+            if len(rows) < batch_size:
+                break
 
 
 class PrintTrialBalanceStart(ModelView):
@@ -1333,6 +1744,7 @@ class TrialBalance(Report):
         pool = Pool()
         Account = pool.get('account.account')
         Period = pool.get('account.period')
+        FiscalYear = pool.get('account.fiscalyear')
         Company = pool.get('company.company')
 
         company = Company(data['company'])
@@ -1367,47 +1779,13 @@ class TrialBalance(Report):
             end_periods = list(set(end_periods).difference(
                     set(start_periods)))
 
-        start_period_ids = [p.id for p in start_periods] or [0]
-        end_period_ids = [p.id for p in end_periods]
-
-        with Transaction().set_context(
-                fiscalyear=data['fiscalyear'],
-                periods=start_period_ids,
-                posted=data['posted']):
-            start_accounts = Account.browse(accounts)
+        amounts = cls.get_amounts(accounts, FiscalYear(data['fiscalyear']),
+            start_periods, end_periods, data['posted'],
+            data['empty_account'])
 
-        with Transaction().set_context(
-                fiscalyear=None,
-                periods=end_period_ids,
-                posted=data['posted']):
-            in_accounts = Account.browse(accounts)
-
-        with Transaction().set_context(
-                fiscalyear=data['fiscalyear'],
-                periods=start_period_ids + end_period_ids,
-                posted=data['posted']):
-            end_accounts = Account.browse(accounts)
-
-        to_remove = set()
-        if not data['empty_account']:
-            for account in in_accounts:
-                if account.debit == Decimal('0.0') \
-                        and account.credit == Decimal('0.0'):
-                    to_remove.add(account)
-
-        accounts = []
-        for start_account, in_account, end_account in izip(
-                start_accounts, in_accounts, end_accounts):
-            if in_account in to_remove:
-                continue
-            accounts.append({
-                    'code': start_account.code,
-                    'name': start_account.name,
-                    'start_balance': start_account.balance,
-                    'debit': in_account.debit,
-                    'credit': in_account.credit,
-                    'end_balance': end_account.balance,
-                    })
+        accounts = [dict(amounts[account.id], code=account.code,
+                name=account.name)
+            for account in accounts if account.id in amounts]
 
         periods = end_periods
 
@@ -1430,6 +1808,80 @@ class TrialBalance(Report):
             amount += account[field]
         return amount
 
+    @classmethod
+    def get_amounts(cls, accounts, fiscalyear, start_periods, end_periods,
+            posted, empty_account=True):
+        '''
+        Return for each account id a dictionary with the start balance, the
+        debit and credit of the end periods and the end balance.
+        The amounts are computed in one query on the period balances.
+        If empty_account is not set, the accounts without debit and credit in
+        the end periods are not returned.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        PeriodBalance = pool.get('account.account.period_balance')
+        cursor = Transaction().cursor
+        in_max = cursor.IN_MAX
+        table = PeriodBalance.__table__()
+
+        start_period_ids = [p.id for p in start_periods]
+        end_period_ids = [p.id for p in end_periods]
+        in_start = table.period.in_(start_period_ids or [None])
+        in_end = table.period.in_(end_period_ids or [None])
+        where = table.period.in_(start_period_ids + end_period_ids or [None])
+        if posted:
+            where &= table.posted
+        columns = [table.account,
+            Sum(Case((in_start, table.debit - table.credit), else_=0)),
+            Sum(Case((in_end, table.debit), else_=0)),
+            Sum(Case((in_end, table.credit), else_=0)),
+            ]
+        having = None
+        if not empty_account:
+            having = (columns[2] != 0) | (columns[3] != 0)
+
+        values = {}
+        ids = [a.id for a in accounts]
+        for i in range(0, len(ids), in_max):
+            sub_ids = ids[i:i + in_max]
+            cursor.execute(*table.select(*columns,
+                    where=reduce_ids(table.account, sub_ids) & where,
+                    group_by=table.account, having=having))
+            for row in cursor.fetchall():
+                account_id = row[0]
+                # SQLite uses float for SUM
+                values[account_id] = [a if isinstance(a, Decimal)
+                    else Decimal(str(a)) for a in row[1:]]
+
+        # The balances include the previous fiscal years like Account.balance
+        with Transaction().set_context(posted=posted):
+            previous = Account._cumulate([fiscalyear], accounts, {
+                    'balance': dict((i, Decimal('0.0')) for i in ids),
+                    }, lambda accounts, names: {
+                    names[0]: Account.get_balance(accounts, names[0]),
+                    })['balance']
+
+        result = {}
+        for account in accounts:
+            if account.id in values:
+                start_balance, debit, credit = values[account.id]
+            elif empty_account:
+                start_balance = debit = credit = Decimal('0.0')
+            else:
+                continue
+            if not empty_account and not debit and not credit:
+                continue
+            start_balance += previous[account.id]
+            round_ = account.company.currency.round
+            result[account.id] = {
+                'start_balance': round_(start_balance),
+                'debit': round_(debit),
+                'credit': round_(credit),
+                'end_balance': round_(start_balance + debit - credit),
+                }
+        return result
+
 
 class OpenBalanceSheetStart(ModelView):
     'Open Balance Sheet'
@@ -1940,37 +2392,32 @@ class ThirdPartyBalance(Report):
         pool = Pool()
         Party = pool.get('party.party')
         MoveLine = pool.get('account.move.line')
-        Move = pool.get('account.move')
         Account = pool.get('account.account')
         Company = pool.get('company.company')
         Date = pool.get('ir.date')
         cursor = Transaction().cursor
 
         line = MoveLine.__table__()
-        move = Move.__table__()
         account = Account.__table__()
 
         company = Company(data['company'])
         localcontext['company'] = company
         localcontext['digits'] = company.currency.digits
         localcontext['fiscalyear'] = data['fiscalyear']
-        with Transaction().set_context(context=localcontext):
+        with Transaction().set_context(context=localcontext,
+                posted=data['posted']):
             line_query, _ = MoveLine.query_get(line)
-        if data['posted']:
-            posted_clause = move.state == 'posted'
-        else:
-            posted_clause = Literal(True)
+        from_ = line.join(account, condition=line.account == account.id)
 
-        cursor.execute(*line.join(move, condition=line.move == move.id
-                ).join(account, condition=line.account == account.id
-                ).select(line.party, Sum(line.debit), Sum(line.credit),
+        cursor.execute(*from_.select(line.party, Sum(line.debit),
+                Sum(line.credit),
                 where=(line.party != None)
                 & account.active
                 & account.kind.in_(('payable', 'receivable'))
                 & (account.company == data['company'])
                 & ((line.maturity_date <= Date.today())
                     | (line.maturity_date == None))
-                & line_query & posted_clause,
+                & line_query,
                 group_by=line.party,
                 having=(Sum(line.debit) != 0) | (Sum(line.credit) != 0)))
 
@@ -2063,6 +2510,7 @@ class OpenAgedBalance(Wizard):
             'term1': self.start.term1,
             'term2': self.start.term2,
             'term3': self.start.term3,
+            'terms': [self.start.term1, self.start.term2, self.start.term3],
             'unit': self.start.unit,
             'posted': self.start.posted,
             'balance_type': self.start.balance_type,
@@ -2078,17 +2526,24 @@ class AgedBalance(Report):
 
     @classmethod
     def parse(cls, report, objects, data, localcontext):
+        cls.set_localcontext(data, localcontext)
+        return super(AgedBalance, cls).parse(report, objects, data,
+            localcontext)
+
+    @classmethod
+    def set_localcontext(cls, data, localcontext):
+        '''
+        Fill the localcontext with the balances of the parties by term
+        '''
         pool = Pool()
         Party = pool.get('party.party')
         MoveLine = pool.get('account.move.line')
-        Move = pool.get('account.move')
         Account = pool.get('account.account')
         Company = pool.get('company.company')
         Date = pool.get('ir.date')
         cursor = Transaction().cursor
 
         line = MoveLine.__table__()
-        move = Move.__table__()
         account = Account.__table__()
 
         company = Company(data['company'])
@@ -2096,8 +2551,11 @@ class AgedBalance(Report):
         localcontext['posted'] = data['posted']
         with Transaction().set_context(context=localcontext):
             line_query, _ = MoveLine.query_get(line)
+        from_ = line.join(account, condition=line.account == account.id)
 
-        terms = (data['term1'], data['term2'], data['term3'])
+        # terms must be sorted in ascending order
+        terms = data.get('terms') or [
+            data['term1'], data['term2'], data['term3']]
         if data['unit'] == 'month':
             coef = datetime.timedelta(days=30)
         else:
@@ -2109,48 +2567,58 @@ class AgedBalance(Report):
             'customer': ('receivable',),
             }[data['balance_type']]
 
-        res = {}
+        whens = []
+        today = Date.today()
         for position, term in enumerate(terms):
-            term_query = line.maturity_date <= (Date.today() - term * coef)
-            if position != 2:
+            term_query = line.maturity_date <= (today - term * coef)
+            if position != len(terms) - 1:
                 term_query &= line.maturity_date > (
-                    Date.today() - terms[position + 1] * coef)
-
-            cursor.execute(*line.join(move, condition=line.move == move.id
-                    ).join(account, condition=line.account == account.id
-                    ).select(line.party, Sum(line.debit) - Sum(line.credit),
-                    where=(line.party != None)
-                    & account.active
-                    & account.kind.in_(kind)
-                    & (line.reconciliation == None)
-                    & (account.company == data['company'])
-                    & term_query & line_query,
-                    group_by=line.party,
-                    having=(Sum(line.debit) - Sum(line.credit)) != 0))
-            for party, solde in cursor.fetchall():
-                if party in res:
-                    res[party][position] = solde
-                else:
-                    res[party] = [(i[0] == position) and solde
-                        or Decimal("0.0") for i in enumerate(terms)]
+                    today - terms[position + 1] * coef)
+            whens.append((term_query, position))
+
+        # The bucket is computed in a sub-query because PostgreSQL can not
+        # group by an expression with parameters
+        query = from_.select(line.party, line.debit, line.credit,
+            Case(*whens, else_=None).as_('position'),
+            where=(line.party != None)
+            & account.active
+            & account.kind.in_(kind)
+            & (line.reconciliation == None)
+            & (account.company == data['company'])
+            & line_query)
+        cursor.execute(*query.select(query.party, query.position,
+                Sum(query.debit) - Sum(query.credit),
+                where=query.position != None,
+                group_by=[query.party, query.position],
+                having=(Sum(query.debit) - Sum(query.credit)) != 0))
+        res = {}
+        for party, position, solde in cursor.fetchall():
+            # SQLite uses float for SUM
+            if not isinstance(solde, Decimal):
+                solde = Decimal(str(solde))
+            res.setdefault(party, [Decimal('0.0')] * len(terms))
+            res[party][position] = solde
         parties = Party.search([
             ('id', 'in', [k for k in res.iterkeys()]),
             ])
 
         localcontext['main_title'] = data['balance_type']
         localcontext['unit'] = data['unit']
-        for i in range(3):
-            localcontext['total' + str(i)] = sum(
-                (v[i] for v in res.itervalues()))
+        localcontext['terms'] = terms
+        localcontext['totals'] = []
+        for i in range(len(terms)):
+            total = sum((v[i] for v in res.itervalues()), Decimal('0.0'))
+            localcontext['totals'].append(total)
+            localcontext['total' + str(i)] = total
             localcontext['term' + str(i)] = terms[i]
 
         localcontext['company'] = company
-        localcontext['parties'] = [{
-                'name': p.rec_name,
-                'amount0': res[p.id][0],
-                'amount1': res[p.id][1],
-                'amount2': res[p.id][2],
-                } for p in parties]
-
-        return super(AgedBalance, cls).parse(report, objects, data,
-            localcontext)
+        localcontext['parties'] = []
+        for party in parties:
+            values = {
+                'name': party.rec_name,
+                'amounts': res[party.id],
+                }
+            for i, amount in enumerate(res[party.id]):
+                values['amount' + str(i)] = amount
+            localcontext['parties'].append(values)
@@ -0,0 +1,107 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from bisect import bisect_right
+from weakref import WeakKeyDictionary
+
+from trytond.transaction import Transaction
+
+__all__ = ['get_tree', 'rollup', 'find_interval', 'cache_get', 'cache_set',
+    'cache_clear']
+
+# The caches cleared by each cursor
+_cleared_caches = WeakKeyDictionary()
+
+
+def get_tree(Model, ids, parent='parent'):
+    '''
+    Return the records of ids with all their descendants (including the
+    inactive ones) using only one search.
+    '''
+    with Transaction().set_context(active_test=False):
+        return Model.search([
+                (parent, 'child_of', ids),
+                ])
+
+
+def rollup(records, values, parent='parent', prune_inactive=False):
+    '''
+    Return for each record the sum of its value and the values of all its
+    descendants.
+    records must contain all the descendants as returned by get_tree.
+    values is a dictionary of record id and the value of the record alone.
+    If prune_inactive is set, the inactive records are not summed into their
+    parent, like with a child_of search on the active records.
+    '''
+    parents = {}
+    for record in records:
+        parent_record = getattr(record, parent)
+        parents[record.id] = parent_record.id if parent_record else None
+
+    depths = {}
+    for record_id in parents:
+        path = []
+        while record_id in parents and record_id not in depths:
+            path.append(record_id)
+            record_id = parents[record_id]
+        depth = depths.get(record_id, -1)
+        for record_id in reversed(path):
+            depth += 1
+            depths[record_id] = depth
+
+    if prune_inactive:
+        inactives = set(r.id for r in records if not r.active)
+    else:
+        inactives = set()
+    result = dict((i, values.get(i, 0)) for i in parents)
+    for record_id in sorted(parents, key=depths.get, reverse=True):
+        parent_id = parents[record_id]
+        if parent_id in result and record_id not in inactives:
+            result[parent_id] += result[record_id]
+    return result
+
+
+def find_interval(intervals, date):
+    '''
+    Return the interval of intervals which contains date or None.
+    intervals is a list of (start, end, ...) tuples sorted by start which do
+    not overlap.
+    '''
+    index = bisect_right(intervals, (date,))
+    if index < len(intervals) and intervals[index][0] == date:
+        return intervals[index]
+    if index and intervals[index - 1][1] >= date:
+        return intervals[index - 1]
+    return None
+
+
+def _cache_cleared(cache):
+    cursor = Transaction().cursor
+    return cursor in _cleared_caches and cache in _cleared_caches[cursor]
+
+
+def cache_get(cache, key):
+    '''
+    Return the value of key in cache or None.
+    The cache is not read by the transactions which cleared it as it could
+    contain values from before their modifications.
+    '''
+    if _cache_cleared(cache):
+        return None
+    return cache.get(key)
+
+
+def cache_set(cache, key, value):
+    '''
+    Store the value of key in cache unless the transaction cleared it as the
+    value may not be committed.
+    '''
+    if not _cache_cleared(cache):
+        cache.set(key, value)
+
+
+def cache_clear(cache):
+    '''
+    Clear cache and bypass it for the rest of the transaction.
+    '''
+    cache.clear()
+    _cleared_caches.setdefault(Transaction().cursor, set()).add(cache)
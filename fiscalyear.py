@@ -8,6 +8,9 @@ from trytond.tools import datetime_strftime
 from trytond.pyson import Eval, If, PYSONEncoder
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.cache import Cache
+
+from .common import find_interval, cache_get, cache_set, cache_clear
 
 __all__ = ['FiscalYear',
     'BalanceNonDeferralStart', 'BalanceNonDeferral',
@@ -50,6 +53,7 @@ class FiscalYear(ModelSQL, ModelView):
             ('id', If(Eval('context', {}).contains('company'), '=', '!='),
                 Eval('context', {}).get('company', -1)),
             ], select=True)
+    _find_cache = Cache('account_fiscalyear.find', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -65,6 +69,8 @@ class FiscalYear(ModelSQL, ModelView):
                     '"%(second)s" have the same post move sequence.'),
                 'account_balance_not_zero': ('The balance of the account "%s" '
                     'must be zero.'),
+                'accounts_balance_not_zero': ('The balance of the accounts '
+                    '"%s" must be zero.'),
                 'close_error': ('You can not close fiscal year "%s" until you '
                     'close all previous fiscal years.'),
                 'reopen_error': ('You can not reopen fiscal year "%s" until '
@@ -133,6 +139,11 @@ class FiscalYear(ModelSQL, ModelView):
                     'second': years[0].rec_name,
                     })
 
+    @classmethod
+    def create(cls, vlist):
+        cache_clear(cls._find_cache)
+        return super(FiscalYear, cls).create(vlist)
+
     @classmethod
     def write(cls, *args):
         actions = iter(args)
@@ -151,12 +162,14 @@ class FiscalYear(ModelSQL, ModelView):
                 values['periods'].sort(lambda x, y:
                     cmp(operator.index(x[0]), operator.index(y[0])))
             args.extend((fiscalyears, values))
+        cache_clear(cls._find_cache)
         super(FiscalYear, cls).write(*args)
 
     @classmethod
     def delete(cls, fiscalyears):
         Period = Pool().get('account.period')
         Period.delete([p for f in fiscalyears for p in f.periods])
+        cache_clear(cls._find_cache)
         super(FiscalYear, cls).delete(fiscalyears)
 
     @classmethod
@@ -211,12 +224,8 @@ class FiscalYear(ModelSQL, ModelView):
 
         if not date:
             date = Date.today()
-        fiscalyears = cls.search([
-            ('start_date', '<=', date),
-            ('end_date', '>=', date),
-            ('company', '=', company_id),
-            ], order=[('start_date', 'DESC')], limit=1)
-        if not fiscalyears:
+        fiscalyear = find_interval(cls._get_find_intervals(company_id), date)
+        if not fiscalyear:
             if exception:
                 language = Transaction().language
                 languages = Lang.search([('code', '=', language)])
@@ -227,28 +236,69 @@ class FiscalYear(ModelSQL, ModelView):
                 cls.raise_user_error('no_fiscalyear_date', (formatted,))
             else:
                 return None
-        return fiscalyears[0].id
+        return fiscalyear[2]
+
+    @classmethod
+    def _get_find_intervals(cls, company_id):
+        '''
+        Return the sorted list of (start date, end date, id) of the fiscal
+        years of the company used by find
+        '''
+        intervals = cache_get(cls._find_cache, company_id)
+        if intervals is None:
+            with Transaction().set_user(0):
+                fiscalyears = cls.search([
+                        ('company', '=', company_id),
+                        ], order=[('start_date', 'ASC')])
+            intervals = [(f.start_date, f.end_date, f.id)
+                for f in fiscalyears]
+            cache_set(cls._find_cache, company_id, intervals)
+        return intervals
 
     def _process_account(self, account):
         '''
         Process account for a fiscal year closed
         '''
-        Currency = Pool().get('currency.currency')
-        Deferral = Pool().get('account.account.deferral')
+        self._process_accounts([account])
 
-        if account.kind == 'view':
+    def _process_accounts(self, accounts):
+        '''
+        Process accounts for a fiscal year closed
+        The amounts are computed for all accounts at once and the deferrals
+        are created in one call.
+        The context must be set to cumulate the amounts of the fiscal year.
+        '''
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Account = pool.get('account.account')
+        Deferral = pool.get('account.account.deferral')
+
+        accounts = [a for a in accounts if a.kind != 'view']
+        deferral_accounts = [a for a in accounts if a.deferral]
+        other_accounts = [a for a in accounts if not a.deferral]
+
+        balances = {}
+        if other_accounts:
+            balances = Account.get_balance(other_accounts, 'balance')
+        not_zero = [a.rec_name for a in other_accounts
+            if not Currency.is_zero(self.company.currency, balances[a.id])]
+        if len(not_zero) == 1:
+            self.raise_user_error('account_balance_not_zero',
+                error_args=(not_zero[0],))
+        elif not_zero:
+            self.raise_user_error('accounts_balance_not_zero',
+                error_args=('", "'.join(not_zero),))
+
+        if not deferral_accounts:
             return
-        if not account.deferral:
-            if not Currency.is_zero(self.company.currency, account.balance):
-                self.raise_user_error('account_balance_not_zero',
-                        error_args=(account.rec_name,))
-        else:
-            Deferral.create([{
-                        'account': account.id,
-                        'fiscalyear': self.id,
-                        'debit': account.debit,
-                        'credit': account.credit,
-                        }])
+        values = Account.get_credit_debit(deferral_accounts,
+            ['debit', 'credit'])
+        Deferral.create([{
+                    'account': a.id,
+                    'fiscalyear': self.id,
+                    'debit': values['debit'][a.id],
+                    'credit': values['credit'][a.id],
+                    } for a in deferral_accounts])
 
     @classmethod
     @ModelView.button
@@ -283,8 +333,7 @@ class FiscalYear(ModelSQL, ModelView):
                 accounts = Account.search([
                         ('company', '=', fiscalyear.company.id),
                         ])
-            for account in accounts:
-                fiscalyear._process_account(account)
+                fiscalyear._process_accounts(accounts)
 
     @classmethod
     @ModelView.button
@@ -348,6 +397,13 @@ class BalanceNonDeferralStart(ModelView):
             ('company', '=', Eval('context', {}).get('company', -1)),
             ('deferral', '=', True),
             ])
+    max_lines = fields.Integer('Maximum Lines',
+        domain=['OR',
+            ('max_lines', '=', None),
+            ('max_lines', '>=', 2),
+            ],
+        help='The maximum number of lines per move.\n'
+        'Leave empty to create only one move.')
 
 
 class BalanceNonDeferral(Wizard):
@@ -360,6 +416,14 @@ class BalanceNonDeferral(Wizard):
             ])
     balance = StateAction('account.act_move_line_form')
 
+    @classmethod
+    def __setup__(cls):
+        super(BalanceNonDeferral, cls).__setup__()
+        cls._error_messages.update({
+                'invalid_max_lines': ('The maximum number of lines per move '
+                    'must be at least 2 instead of "%s".'),
+                })
+
     def get_move_line(self, account):
         pool = Pool()
         Line = pool.get('account.move.line')
@@ -391,13 +455,44 @@ class BalanceNonDeferral(Wizard):
             line.account = self.start.debit_account
         return line
 
+    @staticmethod
+    def _get_line_values(line):
+        '''
+        Return the values of the unsaved line for Move.import_batch
+        '''
+        Move = Pool().get('account.move')
+        values = {}
+        for name in Move._import_line_fields():
+            value = getattr(line, name, None)
+            if value is not None:
+                values[name] = getattr(value, 'id', value)
+        return values
+
     def create_move(self):
+        '''
+        Create the move balancing the non-deferral accounts
+        Only the first move is returned when max_lines splits them.
+        '''
+        moves = self.create_moves()
+        return moves[0] if moves else None
+
+    def create_moves(self):
+        '''
+        Create the moves balancing the non-deferral accounts
+        The balances of the accounts are read in one call and the moves are
+        created with Move.import_batch.
+        '''
         pool = Pool()
         Account = pool.get('account.account')
         Move = pool.get('account.move')
 
+        max_lines = getattr(self.start, 'max_lines', None)
+        if max_lines is not None and max_lines < 2:
+            self.raise_user_error('invalid_max_lines', (max_lines,))
+
         with Transaction().set_context(fiscalyear=self.start.fiscalyear.id,
                 date=None, cumulate=False):
+            # The balance of all the accounts is computed at the first read
             accounts = Account.search([
                     ('company', '=', self.start.fiscalyear.company.id),
                     ('deferral', '=', False),
@@ -409,23 +504,30 @@ class BalanceNonDeferral(Wizard):
             if line:
                 lines.append(line)
         if not lines:
-            return
-        amount = sum(l.debit - l.credit for l in lines)
-        counter_part_line = self.get_counterpart_line(amount)
-        if counter_part_line:
-            lines.append(counter_part_line)
-
-        move = Move()
-        move.period = self.start.period
-        move.journal = self.start.journal
-        move.date = self.start.period.start_date
-        move.origin = self.start.fiscalyear
-        move.lines = lines
-        move.save()
-        return move
+            return []
+
+        # Keep room for the counterpart line
+        size = (max_lines or len(lines) + 1) - 1
+        rows = []
+        for i in range(0, len(lines), size):
+            move_lines = lines[i:i + size]
+            amount = sum(l.debit - l.credit for l in move_lines)
+            counter_part_line = self.get_counterpart_line(amount)
+            if counter_part_line:
+                move_lines.append(counter_part_line)
+            rows.append({
+                    'period': self.start.period.id,
+                    'journal': self.start.journal.id,
+                    'date': self.start.period.start_date,
+                    'origin': str(self.start.fiscalyear),
+                    'lines': [self._get_line_values(l) for l in move_lines],
+                    })
+        with Transaction().set_context(
+                company=self.start.fiscalyear.company.id):
+            return Move.import_batch(rows)
 
     def do_balance(self, action):
-        self.create_move()
+        self.create_moves()
         action['pyson_domain'] = PYSONEncoder().encode([
                 ('origin', '=', str(self.start.fiscalyear)),
                 ])
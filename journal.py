@@ -6,6 +6,10 @@ from trytond import backend
 from trytond.pyson import Eval, Bool
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.cache import Cache
+from trytond.tools import reduce_ids
+
+from .common import cache_get, cache_set, cache_clear
 
 __all__ = ['JournalType', 'JournalView', 'JournalViewColumn', 'Journal',
     'JournalPeriod', 'CloseJournalPeriod', 'ReOpenJournalPeriod']
@@ -190,6 +194,7 @@ class JournalPeriod(ModelSQL, ModelView):
         ('open', 'Open'),
         ('close', 'Close'),
         ], 'State', readonly=True, required=True)
+    _state_cache = Cache('account_journal_period.state', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -241,6 +246,7 @@ class JournalPeriod(ModelSQL, ModelView):
                 if period.state == 'close':
                     cls.raise_user_error('create_journal_period', (
                             period.rec_name,))
+        cache_clear(cls._state_cache)
         return super(JournalPeriod, cls).create(vlist)
 
     @classmethod
@@ -257,13 +263,47 @@ class JournalPeriod(ModelSQL, ModelView):
                                 'journal_period': journal_period.rec_name,
                                 'period': journal_period.period.rec_name,
                                 })
+        cache_clear(cls._state_cache)
         super(JournalPeriod, cls).write(*args)
 
     @classmethod
     def delete(cls, periods):
         cls._check(periods)
+        cache_clear(cls._state_cache)
         super(JournalPeriod, cls).delete(periods)
 
+    @classmethod
+    def get_states(cls, keys):
+        '''
+        Return a dictionary with the state of the active journal - periods
+        for the keys of (journal id, period id).
+        The keys without journal - period are missing from the result.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        states = {}
+        period2journals = {}
+        for key in set(keys):
+            state = cache_get(cls._state_cache, key)
+            if state is not None:
+                states[key] = state
+            else:
+                journal_id, period_id = key
+                period2journals.setdefault(period_id, []).append(journal_id)
+        for period_id, journal_ids in period2journals.iteritems():
+            for i in range(0, len(journal_ids), cursor.IN_MAX):
+                sub_ids = journal_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*table.select(table.journal, table.state,
+                        where=(table.period == period_id)
+                        & reduce_ids(table.journal, sub_ids)
+                        & table.active))
+                for journal_id, state in cursor.fetchall():
+                    key = (journal_id, period_id)
+                    states[key] = state
+                    cache_set(cls._state_cache, key, state)
+        return states
+
     @classmethod
     def close(cls, periods):
         '''
@@ -2,10 +2,23 @@
 #this repository contains the full copyright notices and license terms.
 from decimal import Decimal
 import datetime
-from itertools import groupby
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice, groupby
 from operator import itemgetter
-from sql.aggregate import Sum
-from sql.conditionals import Coalesce
+from weakref import WeakKeyDictionary
+try:
+    from pysqlite2 import dbapi2 as sqlite
+except ImportError:
+    try:
+        import sqlite3 as sqlite
+    except ImportError:
+        sqlite = None
+from sql import Column
+from sql.aggregate import Sum, Min, Max
+from sql.conditionals import Coalesce, Case
+from sql.functions import CurrentTimestamp
 
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
@@ -25,6 +38,15 @@ __all__ = ['Move', 'Reconciliation', 'Line', 'OpenJournalAsk',
     'PrintGeneralJournalStart', 'PrintGeneralJournal', 'GeneralJournal']
 __metaclass__ = PoolMeta
 
+# Sequence numbers reserved by block and not yet used, per database and
+# sequence
+_sequence_blocks = {}
+_sequence_blocks_lock = threading.Lock()
+# Sequence ids used without block by each cursor
+_sequences_used = WeakKeyDictionary()
+# Stack of the move ids to validate later by each cursor
+_deferred_moves = WeakKeyDictionary()
+
 _MOVE_STATES = {
     'readonly': Eval('state') == 'posted',
     }
@@ -33,6 +55,13 @@ _LINE_STATES = {
     'readonly': Eval('state') == 'valid',
     }
 _LINE_DEPENDS = ['state']
+# The fields of the move stored on the lines
+_MOVE_FIELDS = [
+    ('journal', 'journal'),
+    ('period', 'period'),
+    ('date', 'date'),
+    ('move_state', 'state'),
+    ]
 
 
 class Move(ModelSQL, ModelView):
@@ -86,6 +115,10 @@ class Move(ModelSQL, ModelView):
                     'because it\'s date is outside its period.'),
                 'draft_closed_period': ('You can not set to draft move '
                     '"%(move)s" because period "%(period)s" is closed.'),
+                'post_closed_period': ('You can not post move "%(move)s" '
+                    'because period "%(period)s" is closed.'),
+                'import_missing_field': ('You can not import moves without '
+                    'the field "%s".'),
                 })
         cls._buttons.update({
                 'post': {
@@ -203,9 +236,13 @@ class Move(ModelSQL, ModelView):
 
     @classmethod
     def write(cls, *args):
+        MoveLine = Pool().get('account.move.line')
         actions = iter(args)
         all_moves = []
         args = []
+        update_moves = []
+        sync_moves = []
+        lines_args = []
         for moves, values in zip(actions, actions):
             keys = values.keys()
             for key in cls._check_modify_exclude:
@@ -213,25 +250,51 @@ class Move(ModelSQL, ModelView):
                     keys.remove(key)
             if len(keys):
                 cls.check_modify(moves)
+            if 'period' in values or 'state' in values:
+                update_moves.extend(moves)
+                if 'lines' in values:
+                    # The lines update their balances so they are written
+                    # afterwards to not count them twice
+                    values = values.copy()
+                    lines_args.extend((moves, {
+                                'lines': values.pop('lines'),
+                                }))
+            if any(f in values for _, f in _MOVE_FIELDS):
+                sync_moves.extend(moves)
             args.extend((moves, values))
             all_moves.extend(moves)
+        balance_amounts = MoveLine.get_balance_amounts(update_moves)
         super(Move, cls).write(*args)
+        if sync_moves:
+            MoveLine.update_move_fields([m.id for m in sync_moves])
         cls.validate_move(all_moves)
+        MoveLine.update_balances(balance_amounts,
+            MoveLine.get_balance_amounts(update_moves))
+        if lines_args:
+            super(Move, cls).write(*lines_args)
 
     @classmethod
     def create(cls, vlist):
         pool = Pool()
-        Sequence = pool.get('ir.sequence')
         Journal = pool.get('account.journal')
 
         vlist = [x.copy() for x in vlist]
+        # The numbers are taken in the order of vlist for each sequence
+        sequence2vals = {}
         for vals in vlist:
             if not vals.get('number'):
                 journal_id = (vals.get('journal')
                         or Transaction().context.get('journal'))
                 if journal_id:
                     journal = Journal(journal_id)
-                    vals['number'] = Sequence.get_id(journal.sequence.id)
+                    sequence2vals.setdefault(journal.sequence.id,
+                        []).append(vals)
+        block_size = Transaction().context.get('move_number_block')
+        for sequence_id, sequence_vlist in sequence2vals.iteritems():
+            numbers = cls.get_sequence_numbers(sequence_id,
+                len(sequence_vlist), block_size=block_size)
+            for vals, number in zip(sequence_vlist, numbers):
+                vals['number'] = number
 
         moves = super(Move, cls).create(vlist)
         cls.validate_move(moves)
@@ -270,6 +333,7 @@ class Move(ModelSQL, ModelView):
     def validate_move(cls, moves):
         '''
         Validate balanced move
+        Under defer_validation, the moves are only validated at its exit.
         '''
         pool = Pool()
         MoveLine = pool.get('account.move.line')
@@ -278,96 +342,405 @@ class Move(ModelSQL, ModelView):
 
         cursor = Transaction().cursor
 
+        deferred = _deferred_moves.get(cursor)
+        if deferred and deferred[-1] is not None:
+            deferred[-1].update(m.id for m in moves)
+            return
+
         if (Transaction().user == 0
                 and Transaction().context.get('user')):
             user = Transaction().context.get('user')
         else:
             user = Transaction().user
         company = User(user).company
-        amounts = {}
-        move2draft_lines = {}
-        for i in range(0, len(moves), cursor.IN_MAX):
-            sub_moves = moves[i:i + cursor.IN_MAX]
-            sub_move_ids = [m.id for m in sub_moves]
-            red_sql = reduce_ids(line.move, sub_move_ids)
 
+        valid_moves = []
+        draft_moves = []
+        move_ids = list(set(m.id for m in moves))
+        for i in range(0, len(move_ids), cursor.IN_MAX):
+            sub_ids = move_ids[i:i + cursor.IN_MAX]
             cursor.execute(*line.select(line.move,
                     Sum(line.debit - line.credit),
-                    where=red_sql,
+                    Sum(Case((line.state == 'draft', 1), else_=0)),
+                    where=reduce_ids(line.move, sub_ids),
                     group_by=line.move))
-            amounts.update(dict(cursor.fetchall()))
+            for move_id, amount, draft in cursor.fetchall():
+                # SQLite uses float for SUM
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(amount)
+                if not company.currency.is_zero(amount):
+                    draft_moves.append(move_id)
+                elif draft:
+                    valid_moves.append(move_id)
 
-            cursor.execute(*line.select(line.move, line.id,
-                    where=red_sql & (line.state == 'draft'),
-                    order_by=line.move))
-            move2draft_lines.update(dict((k, (j[1] for j in g))
-                    for k, g in groupby(cursor.fetchall(), itemgetter(0))))
-
-        valid_moves = []
-        draft_moves = []
-        for move in moves:
-            if move.id not in amounts:
-                continue
-            amount = amounts[move.id]
-            # SQLite uses float for SUM
-            if not isinstance(amount, Decimal):
-                amount = Decimal(amount)
-            draft_lines = MoveLine.browse(
-                list(move2draft_lines.get(move.id, [])))
-            if not company.currency.is_zero(amount):
-                draft_moves.append(move.id)
-                continue
-            if not draft_lines:
-                continue
-            valid_moves.append(move.id)
         for move_ids, state in (
                 (valid_moves, 'valid'),
                 (draft_moves, 'draft'),
                 ):
-            if move_ids:
-                for i in range(0, len(move_ids), cursor.IN_MAX):
-                    sub_ids = move_ids[i:i + cursor.IN_MAX]
-                    red_sql = reduce_ids(line.move, sub_ids)
-                    # Use SQL to prevent double validate loop
-                    cursor.execute(*line.update(
-                            columns=[line.state],
-                            values=[state],
-                            where=red_sql))
+            for i in range(0, len(move_ids), cursor.IN_MAX):
+                sub_ids = move_ids[i:i + cursor.IN_MAX]
+                # Use SQL to prevent double validate loop
+                cursor.execute(*line.update(
+                        columns=[line.state],
+                        values=[state],
+                        where=reduce_ids(line.move, sub_ids)))
+
+    @classmethod
+    @contextmanager
+    def defer_validation(cls):
+        '''
+        Return a context manager under which the moves are not validated.
+        At the exit, all the moves modified are validated at once unless an
+        exception is raised. It yields the set of the move ids to validate.
+        '''
+        deferred = _deferred_moves.setdefault(Transaction().cursor, [])
+        move_ids = set()
+        deferred.append(move_ids)
+        try:
+            yield move_ids
+        finally:
+            deferred.remove(move_ids)
+        if move_ids:
+            cls.validate_deferred_move(cls.browse(list(move_ids)))
+
+    @classmethod
+    def validate_deferred_move(cls, moves):
+        '''
+        Validate the moves even under defer_validation and update the
+        balances of their lines.
+        '''
+        MoveLine = Pool().get('account.move.line')
+        deferred = _deferred_moves.setdefault(Transaction().cursor, [])
+        move_ids = set(m.id for m in moves)
+        for ids in deferred:
+            if ids is not None:
+                ids.difference_update(move_ids)
+        balance_amounts = MoveLine.get_balance_amounts(moves)
+        deferred.append(None)
+        try:
+            cls.validate_move(moves)
+        finally:
+            deferred.pop()
+        MoveLine.update_balances(balance_amounts,
+            MoveLine.get_balance_amounts(moves))
+
+    @classmethod
+    def _import_line_fields(cls):
+        '''
+        Return the names of the line fields supported by import_batch
+        '''
+        return ['account', 'party', 'debit', 'credit', 'maturity_date',
+            'description', 'second_currency', 'amount_second_currency']
+
+    @classmethod
+    def import_batch(cls, rows, batch_size=1000):
+        '''
+        Create moves and their lines from rows by batch of batch_size moves.
+        rows is an iterable of dictionaries with the values of the move and
+        'lines' as a list of dictionaries with the values of the lines.
+        The period of the moves without one is found from their date.
+        The accounts, periods and journals are read once per batch, the lines
+        are inserted with one query per batch and checked with set-based
+        queries instead of one by one. The overridden create of the lines is
+        not called.
+        The amounts must be Decimal with at most the digits of their currency.
+        Return the list of the created moves.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Account = pool.get('account.account')
+        Period = pool.get('account.period')
+        cursor = Transaction().cursor
+        line = Line.__table__()
+        account = Account.__table__()
+
+        company_id = Transaction().context.get('company')
+        field_names = cls._import_line_fields()
+        columns = [line.create_uid, line.create_date, line.move, line.state]
+        columns += [Column(line, f) for f, _ in _MOVE_FIELDS]
+        columns += [Column(line, f) for f in field_names]
+
+        date2period = {}
+        all_moves = []
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            vlist = []
+            account_ids = set()
+            for row in batch:
+                values = row.copy()
+                lines = values.pop('lines', [])
+                if not values.get('period'):
+                    date = values.get('date')
+                    if not date:
+                        cls.raise_user_error('import_missing_field', ('date',))
+                    if date not in date2period:
+                        date2period[date] = Period.find(company_id,
+                            date=date)
+                    values['period'] = date2period[date]
+                vlist.append(values)
+                for line_values in lines:
+                    unknown = set(line_values) - set(field_names)
+                    if unknown:
+                        Line.raise_user_error('import_unsupported_field',
+                            (', '.join(sorted(unknown)),))
+                    if not line_values.get('account'):
+                        Line.raise_user_error('import_missing_field',
+                            ('account',))
+                    account_ids.add(line_values['account'])
+
+            account2digits = {}
+            for account_ in Account.browse(list(account_ids)):
+                Line(account=account_).check_account()
+                account2digits[account_.id] = {
+                    'debit': account_.currency_digits,
+                    'credit': account_.currency_digits,
+                    'amount_second_currency': (account_.second_currency.digits
+                        if account_.second_currency else 2),
+                    }
+            # The lines are inserted without the digits check of the fields
+            for row in batch:
+                for line_values in row.get('lines', []):
+                    digits = account2digits[line_values['account']]
+                    for name in ('debit', 'credit', 'amount_second_currency'):
+                        value = line_values.get(name)
+                        if value is None:
+                            continue
+                        exp = Decimal(str(10.0 ** -digits[name]))
+                        if (not isinstance(value, Decimal)
+                                or value.quantize(exp) != value):
+                            Line.raise_user_error('import_digits',
+                                (name, value, digits[name]))
+
+            with cls.defer_validation():
+                moves = cls.create(vlist)
+
+            values = []
+            for move, row in zip(moves, batch):
+                move_values = [move.journal.id, move.period.id, move.date,
+                    move.state]
+                for line_values in row.get('lines', []):
+                    line_values = line_values.copy()
+                    line_values.setdefault('debit', Decimal('0.0'))
+                    line_values.setdefault('credit', Decimal('0.0'))
+                    values.append([Transaction().user, CurrentTimestamp(),
+                            move.id, 'draft'] + move_values
+                        + [line_values.get(f) for f in field_names])
+            if values:
+                cursor.execute(*line.insert(columns=columns, values=values))
+
+            move_ids = [m.id for m in moves]
+            for i in range(0, len(move_ids), cursor.IN_MAX):
+                sub_ids = move_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*line.join(account,
+                        condition=line.account == account.id
+                        ).select(line.move,
+                        where=reduce_ids(line.move, sub_ids),
+                        group_by=line.move,
+                        having=Min(account.company) != Max(account.company),
+                        limit=1))
+                row = cursor.fetchone()
+                if row:
+                    cls.raise_user_error('company_in_move',
+                        (cls(row[0]).rec_name,))
+
+            Line.check_journal_periods_modify(
+                (m.journal.id, m.period.id) for m in moves)
+
+            cls.validate_deferred_move(moves)
+            all_moves.extend(moves)
+        return all_moves
+
+    @classmethod
+    def get_sequence_numbers(cls, sequence_id, count, block_size=None):
+        '''
+        Return count numbers of the sequence.
+        If block_size is set, the numbers are taken from a block of at least
+        block_size numbers reserved in a separate committed transaction and
+        handed out by this process. So concurrent transactions do not wait on
+        the sequence until the end of each other but the numbers not used are
+        lost and the prefix and suffix are computed at the reservation.
+        The blocks are only used on PostgreSQL and when the transaction did
+        not already take numbers of the sequence without block, otherwise the
+        separate transaction would wait for the lock held by the current one.
+        '''
+        Sequence = Pool().get('ir.sequence')
+        cursor = Transaction().cursor
+        used = _sequences_used.setdefault(cursor, set())
+        if (block_size and sequence_id not in used
+                and backend.name() == 'postgresql'):
+            key = (cursor.database_name, sequence_id)
+            with _sequence_blocks_lock:
+                numbers = _sequence_blocks.setdefault(key, [])
+                result = numbers[:count]
+                del numbers[:count]
+            if len(result) == count:
+                return result
+            # The block is reserved without holding the lock because the
+            # reservation may wait for a transaction of another thread
+            reserved = cls._reserve_sequence_numbers(sequence_id,
+                max(block_size, count - len(result)))
+            missing = count - len(result)
+            result += reserved[:missing]
+            with _sequence_blocks_lock:
+                numbers = _sequence_blocks.setdefault(key, [])
+                if len(result) == count:
+                    numbers.extend(reserved[missing:])
+                    return result
+                numbers[:0] = result
+        used.add(sequence_id)
+        return [Sequence.get_id(sequence_id) for _ in xrange(count)]
+
+    @classmethod
+    def _reserve_sequence_numbers(cls, sequence_id, count):
+        '''
+        Return count numbers of the sequence taken in a new committed
+        transaction or an empty list if the sequence is not committed yet.
+        '''
+        Sequence = Pool().get('ir.sequence')
+        with Transaction().new_cursor():
+            with Transaction().set_user(0):
+                if not Sequence.search([('id', '=', sequence_id)]):
+                    return []
+            numbers = [Sequence.get_id(sequence_id) for _ in xrange(count)]
+            Transaction().cursor.commit()
+        return numbers
+
+    @classmethod
+    def get_post_partitions(cls, moves):
+        '''
+        Return a dictionary with (company id, period id) as key and the list
+        of draft moves as value.
+        Each partition can be posted in its own transaction by a separate
+        worker as posting only takes shared locks on the periods. The moves
+        are not posted: the callers are responsible for running the
+        partitions in parallel.
+        '''
+        partitions = {}
+        for move in moves:
+            if move.state == 'posted':
+                continue
+            key = (move.period.fiscalyear.company.id, move.period.id)
+            partitions.setdefault(key, []).append(move)
+        return partitions
 
     @classmethod
     @ModelView.button
     def post(cls, moves):
         pool = Pool()
-        Sequence = pool.get('ir.sequence')
         Date = pool.get('ir.date')
         Line = pool.get('account.move.line')
+        Account = pool.get('account.account')
+        Company = pool.get('company.company')
+        Period = pool.get('account.period')
+        Reconciliation = pool.get('account.move.reconciliation')
+        cursor = Transaction().cursor
+        line = Line.__table__()
+        account = Account.__table__()
+        period = Period.__table__()
+
+        # The lines of the deferred moves must be valid to be posted
+        deferred_ids = set()
+        for ids in _deferred_moves.get(cursor, []):
+            if ids is not None:
+                deferred_ids.update(ids)
+        deferred_moves = [m for m in moves if m.id in deferred_ids]
+        if deferred_moves:
+            cls.validate_deferred_move(deferred_moves)
 
+        amounts = {}
+        move_ids = [m.id for m in moves]
+        for i in range(0, len(move_ids), cursor.IN_MAX):
+            sub_ids = move_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*line.join(account,
+                    condition=line.account == account.id
+                    ).select(line.move, Sum(line.debit - line.credit),
+                    Min(account.company),
+                    where=reduce_ids(line.move, sub_ids),
+                    group_by=line.move))
+            amounts.update((m, (a, c)) for m, a, c in cursor.fetchall())
+        companies = dict((c.id, c) for c in Company.browse(
+                list(set(c for _, c in amounts.itervalues()))))
         for move in moves:
-            amount = Decimal('0.0')
-            if not move.lines:
+            if move.id not in amounts:
                 cls.raise_user_error('post_empty_move', (move.rec_name,))
-            company = None
-            for line in move.lines:
-                amount += line.debit - line.credit
-                if not company:
-                    company = line.account.company
-            if not company.currency.is_zero(amount):
+            amount, company_id = amounts[move.id]
+            # SQLite uses float for SUM
+            if not isinstance(amount, Decimal):
+                amount = Decimal(str(amount))
+            if not companies[company_id].currency.is_zero(amount):
                 cls.raise_user_error('post_unbalanced_move', (move.rec_name,))
+
+        # Prevent the periods to be closed until the end of the transaction
+        # and check them once locked
+        periods = list(set(m.period for m in moves))
+        Period.lock_periods(periods, shared=True)
+        period_ids = [p.id for p in periods]
+        for i in range(0, len(period_ids), cursor.IN_MAX):
+            sub_ids = period_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*period.select(period.id,
+                    where=reduce_ids(period.id, sub_ids)
+                    & (period.state == 'close'),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                move = [m for m in moves if m.period.id == row[0]][0]
+                cls.raise_user_error('post_closed_period', {
+                        'move': move.rec_name,
+                        'period': move.period.rec_name,
+                        })
+
+        # The numbers are taken in the order of the moves for each sequence
+        sequence2moves = {}
+        numbered = []
         for move in moves:
-            values = {
-                'state': 'posted',
-                }
-            if not move.post_number:
-                values['post_date'] = Date.today()
-                values['post_number'] = Sequence.get_id(
-                    move.period.post_move_sequence_used.id)
-            cls.write([move], values)
-
-            to_reconcile = [l for l in move.lines
-                if ((line.debit == line.credit == Decimal('0'))
-                    and line.account.reconcile)]
-            if to_reconcile:
-                Line.reconcile(to_reconcile)
+            if move.post_number:
+                numbered.append(move)
+                continue
+            sequence2moves.setdefault(move.period.post_move_sequence_used.id,
+                []).append(move)
+        block_size = Transaction().context.get('move_post_number_block')
+        move2number = {}
+        for sequence_id, sequence_moves in sequence2moves.iteritems():
+            numbers = cls.get_sequence_numbers(sequence_id,
+                len(sequence_moves), block_size=block_size)
+            move2number.update(zip(sequence_moves, numbers))
+        args = []
+        today = Date.today()
+        for move in moves:
+            if move not in move2number:
+                continue
+            args.extend(([move], {
+                        'state': 'posted',
+                        'post_date': today,
+                        'post_number': move2number[move],
+                        }))
+        if numbered:
+            args.extend((numbered, {
+                        'state': 'posted',
+                        }))
+        # Only one write to validate the moves and update the balances once
+        cls.write(*args)
+
+        to_reconcile = []
+        for move in moves:
+            lines = [l for l in move.lines
+                if ((l.debit == l.credit == Decimal('0'))
+                    and l.account.reconcile)]
+            if not lines:
+                continue
+            for l in lines:
+                if l.reconciliation:
+                    Line.raise_user_error('already_reconciled',
+                        error_args=(l.move.number, l.id,))
+            to_reconcile.append({
+                    'lines': [('add', [l.id for l in lines])],
+                    })
+        if to_reconcile:
+            Reconciliation.create(to_reconcile)
 
     @classmethod
     @ModelView.button
@@ -422,9 +795,15 @@ class Reconciliation(ModelSQL, ModelView):
         Sequence = Pool().get('ir.sequence')
 
         vlist = [x.copy() for x in vlist]
-        for vals in vlist:
-            if 'name' not in vals:
-                vals['name'] = Sequence.get('account.move.reconciliation')
+        if any('name' not in vals for vals in vlist):
+            # Search the sequence once for all the reconciliations
+            with Transaction().set_user(0):
+                sequence, = Sequence.search([
+                        ('code', '=', 'account.move.reconciliation'),
+                        ], limit=1)
+            for vals in vlist:
+                if 'name' not in vals:
+                    vals['name'] = Sequence.get_id(sequence.id)
 
         return super(Reconciliation, cls).create(vlist)
 
@@ -439,54 +818,89 @@ class Reconciliation(ModelSQL, ModelView):
 
     @classmethod
     def check_lines(cls, reconciliations):
-        Lang = Pool().get('ir.lang')
-        for reconciliation in reconciliations:
-            debit = Decimal('0.0')
-            credit = Decimal('0.0')
-            account = None
-            party = None
-            for line in reconciliation.lines:
-                if line.state != 'valid':
+        '''
+        Check the lines of the reconciliations with one aggregate query by
+        chunk of reconciliations.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+        Lang = pool.get('ir.lang')
+        cursor = Transaction().cursor
+        line = Line.__table__()
+        account = Account.__table__()
+
+        reconciliation_ids = [r.id for r in reconciliations]
+        for i in range(0, len(reconciliation_ids), cursor.IN_MAX):
+            sub_ids = reconciliation_ids[i:i + cursor.IN_MAX]
+            red_sql = reduce_ids(line.reconciliation, sub_ids)
+            cursor.execute(*line.join(account,
+                    condition=line.account == account.id
+                    ).select(line.reconciliation,
+                    Max(Case((line.state != 'valid', line.id), else_=None)),
+                    Min(line.account), Max(line.account),
+                    Min(Case((account.reconcile == True, 1), else_=0)),
+                    Min(line.party), Max(line.party),
+                    Sum(Coalesce(line.debit, 0)),
+                    Sum(Coalesce(line.credit, 0)),
+                    where=red_sql,
+                    group_by=line.reconciliation))
+            for (reconciliation_id, invalid_line, min_account, max_account,
+                    reconcile, min_party, max_party, debit, credit
+                    ) in cursor.fetchall():
+                if invalid_line:
                     cls.raise_user_error('reconciliation_line_not_valid',
-                        (line.rec_name,))
-                debit += line.debit
-                credit += line.credit
-                if not account:
-                    account = line.account
-                elif account.id != line.account.id:
+                        (Line(invalid_line).rec_name,))
+                if min_account != max_account:
+                    line_, = Line.search([
+                            ('reconciliation', '=', reconciliation_id),
+                            ('account', '=', max_account),
+                            ], limit=1)
                     cls.raise_user_error('reconciliation_different_accounts', {
-                            'line': line.rec_name,
-                            'account1': line.account.rec_name,
-                            'account2': account.rec_name,
+                            'line': line_.rec_name,
+                            'account1': line_.account.rec_name,
+                            'account2': Account(min_account).rec_name,
                             })
-                if not account.reconcile:
+                if not reconcile:
+                    account_ = Account(min_account)
+                    line_, = Line.search([
+                            ('reconciliation', '=', reconciliation_id),
+                            ('account', '=', account_.id),
+                            ], limit=1)
                     cls.raise_user_error('reconciliation_account_no_reconcile',
                         {
-                            'line': line.rec_name,
-                            'account': line.account.rec_name,
+                            'line': line_.rec_name,
+                            'account': account_.rec_name,
                             })
-                if not party:
-                    party = line.party
-                elif line.party and party.id != line.party.id:
+                if min_party != max_party:
+                    line_, = Line.search([
+                            ('reconciliation', '=', reconciliation_id),
+                            ('party', '=', max_party),
+                            ], limit=1)
                     cls.raise_user_error('reconciliation_different_parties', {
-                            'line': line.rec_name,
-                            'party1': line.party.rec_name,
-                            'party2': party.rec_name,
+                            'line': line_.rec_name,
+                            'party1': line_.party.rec_name,
+                            'party2': Party(min_party).rec_name,
+                            })
+                # SQLite uses float for SUM
+                if not isinstance(debit, Decimal):
+                    debit = Decimal(str(debit))
+                if not isinstance(credit, Decimal):
+                    credit = Decimal(str(credit))
+                currency = Account(min_account).company.currency
+                if not currency.is_zero(debit - credit):
+                    language = Transaction().language
+                    languages = Lang.search([('code', '=', language)])
+                    if not languages:
+                        languages = Lang.search([('code', '=', 'en_US')])
+                    language = languages[0]
+                    debit = Lang.currency(language, debit, currency)
+                    credit = Lang.currency(language, credit, currency)
+                    cls.raise_user_error('reconciliation_unbalanced', {
+                            'debit': debit,
+                            'credit': credit,
                             })
-            if not account.company.currency.is_zero(debit - credit):
-                language = Transaction().language
-                languages = Lang.search([('code', '=', language)])
-                if not languages:
-                    languages = Lang.search([('code', '=', 'en_US')])
-                language = languages[0]
-                debit = Lang.currency(
-                    language, debit, account.company.currency)
-                credit = Lang.currency(
-                    language, credit, account.company.currency)
-                cls.raise_user_error('reconciliation_unbalanced', {
-                        'debit': debit,
-                        'credit': credit,
-                        })
 
 
 class Line(ModelSQL, ModelView):
@@ -507,15 +921,9 @@ class Line(ModelSQL, ModelView):
             'readonly': Eval('state') == 'valid',
             },
         depends=['state'])
-    journal = fields.Function(fields.Many2One('account.journal', 'Journal'),
-            'get_move_field', setter='set_move_field',
-            searcher='search_move_field')
-    period = fields.Function(fields.Many2One('account.period', 'Period'),
-            'get_move_field', setter='set_move_field',
-            searcher='search_move_field')
-    date = fields.Function(fields.Date('Effective Date', required=True),
-            'get_move_field', setter='set_move_field',
-            searcher='search_move_field')
+    journal = fields.Many2One('account.journal', 'Journal', select=True)
+    period = fields.Many2One('account.period', 'Period', select=True)
+    date = fields.Date('Effective Date', required=True, select=True)
     origin = fields.Function(fields.Reference('Origin',
             selection='get_origin'),
         'get_move_field', searcher='search_move_field')
@@ -540,10 +948,10 @@ class Line(ModelSQL, ModelView):
     reconciliation = fields.Many2One('account.move.reconciliation',
             'Reconciliation', readonly=True, ondelete='SET NULL', select=True)
     tax_lines = fields.One2Many('account.tax.line', 'move_line', 'Tax Lines')
-    move_state = fields.Function(fields.Selection([
+    move_state = fields.Selection([
         ('draft', 'Draft'),
         ('posted', 'Posted'),
-        ], 'Move State'), 'get_move_field', searcher='search_move_field')
+        ], 'Move State', readonly=True)
     currency_digits = fields.Function(fields.Integer('Currency Digits'),
             'get_currency_digits')
     second_currency_digits = fields.Function(fields.Integer(
@@ -553,6 +961,9 @@ class Line(ModelSQL, ModelView):
     def __setup__(cls):
         super(Line, cls).__setup__()
         cls._check_modify_exclude = ['reconciliation']
+        # The models storing balances updated with the lines
+        cls._balance_models = ['account.account.period_balance',
+            'account.account.party_balance']
         cls._sql_constraints += [
             ('credit_debit',
                 'CHECK(credit * debit = 0.0)',
@@ -577,6 +988,12 @@ class Line(ModelSQL, ModelView):
                 'move_inactive_account': ('You can not create a move line '
                     'with account "%s" because it is inactive.'),
                 'already_reconciled': 'Line "%s" (%d) already reconciled.',
+                'import_unsupported_field': ('You can not import lines with '
+                    'the fields "%s".'),
+                'import_missing_field': ('You can not import lines without '
+                    'the field "%s".'),
+                'import_digits': ('You can not import lines with "%s" of '
+                    '"%s" because it has more than %s digits.'),
                 })
 
     @classmethod
@@ -589,11 +1006,21 @@ class Line(ModelSQL, ModelView):
         if table.column_exist('reference'):
             table.column_rename('reference', 'description')
 
+        # Migration from 3.0: store the move fields on the lines
+        fill_move_fields = not table.column_exist('move_state')
+
         super(Line, cls).__register__(module_name)
 
         table = TableHandler(cursor, cls, module_name)
+        if fill_move_fields:
+            cls.update_move_fields()
+            table.not_null_action('date', action='add')
+
         # Index for General Ledger
         table.index_action(['move', 'account'], 'add')
+        table.index_action(['account', 'date'], 'add')
+        table.index_action(['party', 'account', 'reconciliation'], 'add')
+        cls._create_open_indexes()
 
         # Migration from 1.2
         table.not_null_action('blocked', action='remove')
@@ -603,6 +1030,67 @@ class Line(ModelSQL, ModelView):
         table.not_null_action('active', action='remove')
         table.index_action('active', action='remove')
 
+    @classmethod
+    def _open_indexes(cls):
+        '''
+        Return the list of (name, columns) of the partial indexes on the
+        unreconciled lines
+        '''
+        return [
+            (cls._table + '_open_party_index',
+                ['party', 'account', 'maturity_date']),
+            (cls._table + '_open_account_index',
+                ['account', 'party', 'maturity_date']),
+            ]
+
+    @classmethod
+    def _create_open_indexes(cls):
+        '''
+        Create the partial indexes on the unreconciled lines if the backend
+        supports them
+        '''
+        cursor = Transaction().cursor
+        if not cls.support_open_indexes():
+            return
+        existing = cls.open_indexes_exist()
+        for name, columns in cls._open_indexes():
+            if existing[name]:
+                continue
+            cursor.execute('CREATE INDEX "%s" ON "%s" (%s) '
+                'WHERE "reconciliation" IS NULL' % (name, cls._table,
+                    ', '.join('"%s"' % c for c in columns)))
+
+    @staticmethod
+    def support_open_indexes():
+        '''
+        Return if the backend supports the partial indexes
+        '''
+        if backend.name() == 'postgresql':
+            return True
+        elif backend.name() == 'sqlite':
+            # Partial indexes are available since SQLite 3.8.0
+            return sqlite.sqlite_version_info >= (3, 8, 0)
+        return False
+
+    @classmethod
+    def open_indexes_exist(cls):
+        '''
+        Return a dictionary with for each partial index on the unreconciled
+        lines if it is present in the database
+        '''
+        cursor = Transaction().cursor
+        names = [n for n, _ in cls._open_indexes()]
+        if not cls.support_open_indexes():
+            return dict((n, False) for n in names)
+        elif backend.name() == 'postgresql':
+            cursor.execute('SELECT indexname FROM pg_indexes '
+                'WHERE tablename = %s', (cls._table,))
+        else:
+            cursor.execute('SELECT name FROM sqlite_master '
+                'WHERE type = \'index\' AND tbl_name = ?', (cls._table,))
+        existing = set(n for n, in cursor.fetchall())
+        return dict((n, n in existing) for n in names)
+
     @classmethod
     def default_date(cls):
         '''
@@ -1037,15 +1525,12 @@ class Line(ModelSQL, ModelView):
     def get_move_field(self, name):
         if name.startswith('move_'):
             name = name[5:]
-        if name in ('date', 'state', 'description'):
-            return getattr(self.move, name)
-        elif name == 'origin':
+        if name == 'origin':
             origin = getattr(self.move, name)
             if origin:
                 return str(origin)
             return None
-        else:
-            return getattr(self.move, name).id
+        return getattr(self.move, name)
 
     @classmethod
     def set_move_field(cls, lines, name, value):
@@ -1079,11 +1564,30 @@ class Line(ModelSQL, ModelView):
                 tables['move'] = move_tables
             return field.convert_order(name, move_tables, Move)
         return staticmethod(order_field)
-    order_journal = _order_move_field('journal')
-    order_period = _order_move_field('period')
-    order_date = _order_move_field('date')
     order_origin = _order_move_field('origin')
-    order_move_state = _order_move_field('state')
+
+    @classmethod
+    def update_move_fields(cls, move_ids=None):
+        '''
+        Copy on the lines the fields stored from their move
+        If move_ids is None, all the lines are updated.
+        '''
+        Move = Pool().get('account.move')
+        cursor = Transaction().cursor
+        line = cls.__table__()
+        move = Move.__table__()
+
+        columns = [Column(line, f) for f, _ in _MOVE_FIELDS]
+        values = [move.select(Column(move, f), where=move.id == line.move)
+            for _, f in _MOVE_FIELDS]
+        if move_ids is None:
+            cursor.execute(*line.update(columns=columns, values=values))
+            return
+        move_ids = list(set(move_ids))
+        for i in range(0, len(move_ids), cursor.IN_MAX):
+            sub_ids = move_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*line.update(columns=columns, values=values,
+                    where=reduce_ids(line.move, sub_ids)))
 
     @classmethod
     def query_get(cls, table):
@@ -1094,9 +1598,7 @@ class Line(ModelSQL, ModelView):
         '''
         pool = Pool()
         FiscalYear = pool.get('account.fiscalyear')
-        Move = pool.get('account.move')
         Period = pool.get('account.period')
-        move = Move.__table__()
         period = Period.__table__()
 
         if Transaction().context.get('date'):
@@ -1104,47 +1606,17 @@ class Line(ModelSQL, ModelView):
                     ('start_date', '<=', Transaction().context['date']),
                     ('end_date', '>=', Transaction().context['date']),
                     ], limit=1)
-
             fiscalyear_id = fiscalyears and fiscalyears[0].id or 0
-
-            if Transaction().context.get('posted'):
-                return ((table.state != 'draft')
-                    & table.move.in_(move.join(period,
-                            condition=move.period == period.id
-                            ).select(move.id,
-                            where=(period.fiscalyear == fiscalyear_id)
-                            & (move.date <= Transaction().context['date'])
-                            & (move.state == 'posted'))),
-                    [f.id for f in fiscalyears])
-            else:
-                return ((table.state != 'draft')
-                    & table.move.in_(move.join(period,
-                            condition=move.period == period.id
-                            ).select(move.id,
-                            where=(period.fiscalyear == fiscalyear_id)
-                            & (move.date <= Transaction().context['date']))),
-                    [f.id for f in fiscalyears])
-
-        if Transaction().context.get('periods'):
+            fiscalyear_ids = [f.id for f in fiscalyears]
+            clause = (table.period.in_(period.select(period.id,
+                        where=period.fiscalyear == fiscalyear_id))
+                & (table.date <= Transaction().context['date']))
+        elif Transaction().context.get('periods'):
             if Transaction().context.get('fiscalyear'):
                 fiscalyear_ids = [Transaction().context['fiscalyear']]
             else:
                 fiscalyear_ids = []
-            if Transaction().context.get('posted'):
-                return ((table.state != 'draft')
-                    & table.move.in_(
-                            move.select(move.id,
-                                where=move.period.in_(
-                                    Transaction().context['periods'])
-                                & (move.state == 'posted'))),
-                    fiscalyear_ids)
-            else:
-                return ((table.state != 'draft')
-                    & table.move.in_(
-                        move.select(move.id,
-                            where=move.period.in_(
-                                Transaction().context['periods']))),
-                    fiscalyear_ids)
+            clause = table.period.in_(Transaction().context['periods'])
         else:
             if not Transaction().context.get('fiscalyear'):
                 fiscalyears = FiscalYear.search([
@@ -1153,26 +1625,34 @@ class Line(ModelSQL, ModelView):
                 fiscalyear_ids = [f.id for f in fiscalyears] or [0]
             else:
                 fiscalyear_ids = [Transaction().context.get('fiscalyear')]
+            clause = table.period.in_(period.select(period.id,
+                    where=period.fiscalyear.in_(fiscalyear_ids)))
 
-            if Transaction().context.get('posted'):
-                return ((table.state != 'draft')
-                    & table.move.in_(
-                        move.select(move.id,
-                            where=move.period.in_(
-                                period.select(period.id,
-                                    where=period.fiscalyear.in_(
-                                        fiscalyear_ids)))
-                            & (move.state == 'posted'))),
-                    fiscalyear_ids)
-            else:
-                return ((table.state != 'draft')
-                    & table.move.in_(
-                        move.select(move.id,
-                            where=move.period.in_(
-                                period.select(period.id,
-                                    where=period.fiscalyear.in_(
-                                        fiscalyear_ids))))),
-                    fiscalyear_ids)
+        if Transaction().context.get('posted'):
+            clause &= table.move_state == 'posted'
+        return (table.state != 'draft') & clause, fiscalyear_ids
+
+    @classmethod
+    def get_balance_amounts(cls, moves):
+        '''
+        Return the amounts of the lines of the moves for each stored balance
+        as a dictionary with the balance model name as key
+        '''
+        pool = Pool()
+        if not moves:
+            return {}
+        return dict((name, pool.get(name).get_amounts(moves))
+            for name in cls._balance_models)
+
+    @classmethod
+    def update_balances(cls, old, new):
+        '''
+        Update the stored balances with the difference between the new and
+        the old amounts returned by get_balance_amounts
+        '''
+        pool = Pool()
+        for name in set(old) | set(new):
+            pool.get(name).update(old.get(name, {}), new.get(name, {}))
 
     @classmethod
     def on_write(cls, lines):
@@ -1198,49 +1678,90 @@ class Line(ModelSQL, ModelView):
         Check if the lines can be modified or created for the journal - period
         and if there is no journal - period, create it
         '''
-        JournalPeriod = Pool().get('account.journal.period')
-        journal_periods = JournalPeriod.search([
-                ('journal', '=', journal.id),
-                ('period', '=', period.id),
-                ], limit=1)
-        if journal_periods:
-            journal_period, = journal_periods
-            if journal_period.state == 'close':
+        cls.check_journal_periods_modify([(journal.id, period.id)])
+
+    @classmethod
+    def check_journal_periods_modify(cls, keys):
+        '''
+        Check if the lines can be modified or created for the keys of
+        (journal id, period id) and create at once the missing journal -
+        periods
+        '''
+        pool = Pool()
+        JournalPeriod = pool.get('account.journal.period')
+        Journal = pool.get('account.journal')
+        Period = pool.get('account.period')
+
+        keys = set(keys)
+        states = JournalPeriod.get_states(keys)
+        missing = []
+        for key in keys:
+            state = states.get(key)
+            if state == 'close':
+                journal_id, period_id = key
+                journal_period, = JournalPeriod.search([
+                        ('journal', '=', journal_id),
+                        ('period', '=', period_id),
+                        ], limit=1)
                 cls.raise_user_error('add_modify_closed_journal_period', (
                         journal_period.rec_name,))
-        else:
-            JournalPeriod.create([{
+            elif state is None:
+                missing.append(key)
+        if missing:
+            vlist = []
+            for key in missing:
+                journal, period = Journal(key[0]), Period(key[1])
+                vlist.append({
                         'name': journal.name + ' - ' + period.name,
                         'journal': journal.id,
                         'period': period.id,
-                        }])
+                        })
+            JournalPeriod.create(vlist)
 
     @classmethod
     def check_modify(cls, lines):
         '''
         Check if the lines can be modified
         '''
-        journal_period_done = []
-        for line in lines:
-            if line.move.state == 'posted':
-                cls.raise_user_error('modify_posted_move', (
-                        line.move.rec_name,))
-            if line.reconciliation:
-                cls.raise_user_error('modify_reconciled', (
-                        line.rec_name,))
-            journal_period = (line.journal.id, line.period.id)
-            if journal_period not in journal_period_done:
-                cls.check_journal_period_modify(line.period,
-                        line.journal)
-                journal_period_done.append(journal_period)
+        pool = Pool()
+        Move = pool.get('account.move')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        move = Move.__table__()
+
+        journal_periods = set()
+        line_ids = [l.id for l in lines]
+        for i in range(0, len(line_ids), cursor.IN_MAX):
+            sub_ids = line_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.join(move,
+                    condition=table.move == move.id
+                    ).select(move.journal, move.period,
+                    Max(Case((move.state == 'posted', move.id),
+                            else_=None)),
+                    Max(Case((table.reconciliation != None, table.id),
+                            else_=None)),
+                    where=reduce_ids(table.id, sub_ids),
+                    group_by=[move.journal, move.period]))
+            for journal_id, period_id, posted_id, reconciled_id in \
+                    cursor.fetchall():
+                if posted_id:
+                    cls.raise_user_error('modify_posted_move', (
+                            Move(posted_id).rec_name,))
+                if reconciled_id:
+                    cls.raise_user_error('modify_reconciled', (
+                            cls(reconciled_id).rec_name,))
+                journal_periods.add((journal_id, period_id))
+        cls.check_journal_periods_modify(journal_periods)
 
     @classmethod
     def delete(cls, lines):
         Move = Pool().get('account.move')
         cls.check_modify(lines)
         moves = [x.move for x in lines]
+        balance_amounts = cls.get_balance_amounts(moves)
         super(Line, cls).delete(lines)
         Move.validate_move(moves)
+        cls.update_balances(balance_amounts, cls.get_balance_amounts(moves))
 
     @classmethod
     def write(cls, *args):
@@ -1250,17 +1771,53 @@ class Line(ModelSQL, ModelView):
         args = []
         moves = []
         all_lines = []
+        update_lines = []
+        reconcile_lines = []
+        move_args = []
+        sync_move_ids = []
         for lines, values in zip(actions, actions):
             if any(k not in cls._check_modify_exclude for k in values):
                 cls.check_modify(lines)
+                update_lines.extend(lines)
+            elif 'reconciliation' in values:
+                reconcile_lines.extend(lines)
             moves.extend((x.move for x in lines))
             all_lines.extend(lines)
+
+            # The move fields are written on the moves which update the lines
+            values = values.copy()
+            move_values = {}
+            for field, move_field in _MOVE_FIELDS:
+                value = values.pop(field, None)
+                if value and field != 'move_state':
+                    move_values[move_field] = value
+            if move_values:
+                move_args.extend((list(set(l.move for l in lines)),
+                        move_values))
+            if values.get('move'):
+                sync_move_ids.append(values['move'])
             args.extend((lines, values))
 
+        # The moves update the balances of their lines so they are written
+        # first to not count them twice
+        if move_args:
+            Move.write(*move_args)
+        # The reconciliation changes only the party balances but they are
+        # computed with the others to not count twice the moves of both
+        update_moves = []
+        if update_lines or reconcile_lines:
+            update_moves = list(set(l.move for l in update_lines)
+                | set(l.move for l in reconcile_lines)
+                | set(Move.browse(sync_move_ids)))
+        balance_amounts = cls.get_balance_amounts(update_moves)
         super(Line, cls).write(*args)
+        if sync_move_ids:
+            cls.update_move_fields(sync_move_ids)
 
         Transaction().timestamp = {}
         Move.validate_move(list(set(l.move for l in all_lines) | set(moves)))
+        cls.update_balances(balance_amounts,
+            cls.get_balance_amounts(update_moves))
 
     @classmethod
     def create(cls, vlist):
@@ -1282,15 +1839,39 @@ class Line(ModelSQL, ModelView):
                                 'journal': journal_id,
                                 'date': vals.get('date'),
                                 }])[0].id
-            else:
-                # prevent computation of default date
-                vals.setdefault('date', None)
+
+        # The move fields are stored on the lines and the values given for
+        # them are written on the moves
+        moves = dict((m.id, m) for m in Move.browse(
+                list(set(vals['move'] for vals in vlist))))
+        move_args = []
+        for vals in vlist:
+            move = moves[vals['move']]
+            move_values = {}
+            for field, move_field in _MOVE_FIELDS:
+                move_value = getattr(move, move_field)
+                move_value = getattr(move_value, 'id', move_value)
+                value = vals.get(field)
+                if (value and field != 'move_state'
+                        and value != move_value):
+                    move_values[move_field] = value
+                else:
+                    vals[field] = move_value
+            if move_values:
+                move_args.extend(([move], move_values))
+        if move_args:
+            Move.write(*move_args)
+        balance_amounts = cls.get_balance_amounts(moves.values())
         lines = super(Line, cls).create(vlist)
-        period_and_journals = set((line.period, line.journal)
-            for line in lines)
-        for period, journal in period_and_journals:
-            cls.check_journal_period_modify(period, journal)
-        Move.validate_move(list(set(line.move for line in lines)))
+        if move_args:
+            # The values were copied from the moves before they were written
+            # and the last value written for a move wins
+            cls.update_move_fields([m.id for m, in move_args[::2]])
+        cls.check_journal_periods_modify(set(
+                (line.journal.id, line.period.id) for line in lines))
+        moves = list(set(line.move for line in lines))
+        Move.validate_move(moves)
+        cls.update_balances(balance_amounts, cls.get_balance_amounts(moves))
         return lines
 
     @classmethod
@@ -1360,66 +1941,252 @@ class Line(ModelSQL, ModelView):
     @classmethod
     def reconcile(cls, lines, journal=None, date=None, account=None,
             description=None):
+        reconciliation, = cls.reconcile_many([lines], journal=journal,
+            date=date, account=account, description=description)
+        return reconciliation
+
+    @classmethod
+    def reconcile_many(cls, groups, journal=None, date=None, account=None,
+            description=None):
+        '''
+        Reconcile each group of lines and return the reconciliations.
+        If a journal is given, a write-off move is created for the groups
+        which do not sum to zero.
+        '''
         pool = Pool()
         Move = pool.get('account.move')
         Reconciliation = pool.get('account.move.reconciliation')
         Period = pool.get('account.period')
         Date = pool.get('ir.date')
+        cursor = Transaction().cursor
+        table = cls.__table__()
 
-        for line in lines:
-            if line.reconciliation:
-                cls.raise_user_error('already_reconciled',
-                        error_args=(line.move.number, line.id,))
+        groups = [list(g) for g in groups if g]
+        line_ids = list(set(l.id for g in groups for l in g))
+        amounts = {}
+        for i in range(0, len(line_ids), cursor.IN_MAX):
+            sub_ids = line_ids[i:i + cursor.IN_MAX]
+            red_sql = reduce_ids(table.id, sub_ids)
+            cursor.execute(*table.select(table.id, table.reconciliation,
+                    Coalesce(table.debit, 0) - Coalesce(table.credit, 0),
+                    where=red_sql))
+            for line_id, reconciliation, amount in cursor.fetchall():
+                if reconciliation:
+                    line = cls(line_id)
+                    cls.raise_user_error('already_reconciled',
+                            error_args=(line.move.number, line.id,))
+                # SQLite uses float for NUMERIC
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                amounts[line_id] = amount
+
+        if not date:
+            date = Date.today()
+        periods = {}
+        move_vlist = []
+        writeoffs = []
+        for group in groups:
+            reconcile_account = group[0].account
+            amount = reconcile_account.currency.round(
+                sum((amounts[l.id] for l in group), Decimal('0.0')))
+            writeoff_account = account
+            if not writeoff_account and journal:
+                if amount >= 0:
+                    writeoff_account = journal.debit_account
+                else:
+                    writeoff_account = journal.credit_account
+            if not (journal and writeoff_account):
+                continue
+            company_id = reconcile_account.company.id
+            if company_id not in periods:
+                periods[company_id] = Period.find(company_id, date=date)
+            debit = amount < Decimal('0.0') and - amount or Decimal('0.0')
+            credit = amount > Decimal('0.0') and amount or Decimal('0.0')
+            move_vlist.append({
+                    'journal': journal.id,
+                    'period': periods[company_id],
+                    'date': date,
+                    'description': description,
+                    'lines': [
+                        ('create', [{
+                                    'account': reconcile_account.id,
+                                    'debit': debit,
+                                    'credit': credit,
+                                    }, {
+                                    'account': writeoff_account.id,
+                                    'debit': credit,
+                                    'credit': debit,
+                                    }]),
+                        ],
+                    })
+            writeoffs.append((group, reconcile_account, debit, credit))
+
+        for move, (group, reconcile_account, debit, credit) in zip(
+                Move.create(move_vlist), writeoffs):
+            # The write-off line is taken from the new move instead of
+            # searching it
+            for line in move.lines:
+                if (line.account == reconcile_account
+                        and line.debit == debit
+                        and line.credit == credit):
+                    group.append(line)
+                    break
 
-        lines = lines[:]
-        reconcile_account = None
-        amount = Decimal('0.0')
-        for line in lines:
-            amount += line.debit - line.credit
-            if not reconcile_account:
-                reconcile_account = line.account
-        amount = reconcile_account.currency.round(amount)
-        if not account and journal:
-            if amount >= 0:
-                account = journal.debit_account
-            else:
-                account = journal.credit_account
-        if journal and account:
-            if not date:
-                date = Date.today()
-            period_id = Period.find(reconcile_account.company.id, date=date)
-            move, = Move.create([{
-                        'journal': journal.id,
-                        'period': period_id,
-                        'date': date,
-                        'description': description,
-                        'lines': [
-                            ('create', [{
-                                        'account': reconcile_account.id,
-                                        'debit': (amount < Decimal('0.0')
-                                            and - amount or Decimal('0.0')),
-                                        'credit': (amount > Decimal('0.0')
-                                            and amount or Decimal('0.0')),
-                                        }, {
-                                        'account': account.id,
-                                        'debit': (amount > Decimal('0.0')
-                                            and amount or Decimal('0.0')),
-                                        'credit': (amount < Decimal('0.0')
-                                            and - amount or Decimal('0.0')),
-                                        }]),
-                            ],
-                        }])
-            lines += cls.search([
-                    ('move', '=', move.id),
-                    ('account', '=', reconcile_account.id),
-                    ('debit', '=', amount < Decimal('0.0') and - amount
-                        or Decimal('0.0')),
-                    ('credit', '=', amount > Decimal('0.0') and amount
-                        or Decimal('0.0')),
-                    ], limit=1)
         return Reconciliation.create([{
-                    'lines': [('add', [x.id for x in lines])],
-                    }])[0]
+                    'lines': [('add', [x.id for x in group])],
+                    } for group in groups])
+
+    @classmethod
+    def auto_reconcile(cls, accounts=None, partition=None, max_size=4,
+            max_candidates=20, batch_size=1000):
+        '''
+        Reconcile by account and party the unreconciled valid lines which
+        sum to zero and return the reconciliations.
+        accounts is the list of reconcilable accounts to process, by default
+        all of the company in the context.
+        partition is a tuple (index, count) to process only the parties for
+        which id modulo count equals index (the lines without party belong to
+        the index 0). Workers with different indexes can run in parallel as
+        they never reconcile the same lines.
+        max_size and max_candidates limit the search of the lines matching
+        the amount of one line.
+        The reconciliations are created by batch of batch_size.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        Reconciliation = pool.get('account.move.reconciliation')
+        cursor = Transaction().cursor
+        line = cls.__table__()
+
+        if accounts is None:
+            accounts = Account.search([
+                    ('company', '=', Transaction().context.get('company')),
+                    ('reconcile', '=', True),
+                    ])
+
+        where = ((line.state == 'valid')
+            & (line.reconciliation == None))
+        if partition:
+            index, count = partition
+            party_where = (line.party % count) == index
+            if index == 0:
+                party_where |= line.party == None
+            where &= party_where
+
+        to_create = []
+        for account in accounts:
+            if not account.reconcile:
+                continue
+            cursor.execute(*line.select(line.party, line.id,
+                    Coalesce(line.debit, 0) - Coalesce(line.credit, 0),
+                    where=where & (line.account == account.id),
+                    order_by=[line.party, line.maturity_date, line.date,
+                        line.id]))
+            # The rows are fetched one party at a time and the
+            # reconciliations are created once the cursor is consumed
+            for _, rows in groupby(iter(cursor.fetchone, None),
+                    key=itemgetter(0)):
+                amounts = []
+                for _, line_id, amount in rows:
+                    # SQLite uses float for NUMERIC
+                    if not isinstance(amount, Decimal):
+                        amount = Decimal(str(amount))
+                    amounts.append((line_id, amount))
+                for group in cls._match_amounts(amounts, max_size,
+                        max_candidates):
+                    to_create.append({
+                            'lines': [('add', group)],
+                            })
+
+        reconciliations = []
+        for i in xrange(0, len(to_create), batch_size):
+            reconciliations += Reconciliation.create(
+                to_create[i:i + batch_size])
+        return reconciliations
+
+    @classmethod
+    def _match_amounts(cls, amounts, max_size, max_candidates):
+        '''
+        Return the groups of line ids which sum to zero.
+        amounts is the list of (line id, amount) in order of preference.
+        It tries first to match the lines one to one, then one to many with
+        at most max_size lines among max_candidates candidates, and finally
+        all the remaining lines together.
+        '''
+        groups = []
+        remaining = dict(amounts)
+
+        # One to one with a hash index on the amounts
+        amount2ids = {}
+        for line_id, amount in amounts:
+            amount2ids.setdefault(amount, []).append(line_id)
+        for line_id, amount in amounts:
+            if line_id not in remaining or not amount:
+                continue
+            for other_id in amount2ids.get(-amount, []):
+                if other_id in remaining:
+                    groups.append([line_id, other_id])
+                    del remaining[line_id]
+                    del remaining[other_id]
+                    break
+
+        # One to many with a bounded search using the hash index for the last
+        # line of each combination. The candidates are taken among the first
+        # max_candidates remaining lines of opposite sign.
+        sign2remaining = {
+            True: OrderedDict(),
+            False: OrderedDict(),
+            }
+        for line_id, amount in amounts:
+            if line_id in remaining and amount:
+                sign2remaining[amount > 0][line_id] = amount
+        for line_id, amount in amounts:
+            if line_id not in remaining or not amount:
+                continue
+            opposites = sign2remaining[amount < 0]
+            candidates = [(i, a)
+                for i, a in islice(opposites.iteritems(), max_candidates)
+                if abs(a) < abs(amount)]
+            group = cls._find_subset(-amount, candidates, max_size - 1)
+            if group:
+                groups.append([line_id] + group)
+                for i in [line_id] + group:
+                    del sign2remaining[remaining.pop(i) > 0][i]
+
+        # All the remaining lines
+        if len(remaining) > 1 and not sum(remaining.itervalues()):
+            groups.append(remaining.keys())
+        return groups
+
+    @staticmethod
+    def _find_subset(target, candidates, max_size):
+        '''
+        Return the ids of at least 2 and at most max_size candidates whose
+        amounts sum to target or None.
+        candidates is a list of (id, amount).
+        '''
+        amount2index = {}
+        for index, (_, amount) in enumerate(candidates):
+            amount2index.setdefault(amount, []).append(index)
+
+        def search(start, size, total, chosen):
+            if size == 1:
+                for index in amount2index.get(target - total, []):
+                    if index >= start:
+                        return chosen + [index]
+                return None
+            for index in xrange(start, len(candidates)):
+                found = search(index + 1, size - 1,
+                    total + candidates[index][1], chosen + [index])
+                if found:
+                    return found
+            return None
+
+        for size in xrange(2, max_size + 1):
+            found = search(0, size, Decimal(0), [])
+            if found:
+                return [candidates[i][0] for i in found]
+        return None
 
 
 class OpenJournalAsk(ModelView):
@@ -70,12 +70,15 @@ class Party:
         pool = Pool()
         MoveLine = pool.get('account.move.line')
         Account = pool.get('account.account')
+        PeriodBalance = pool.get('account.account.period_balance')
+        PartyBalance = pool.get('account.account.party_balance')
         User = pool.get('res.user')
         Date = pool.get('ir.date')
         cursor = Transaction().cursor
 
         line = MoveLine.__table__()
         account = Account.__table__()
+        balance = PartyBalance.__table__()
 
         for name in names:
             if name not in ('receivable', 'payable',
@@ -91,31 +94,44 @@ class Party:
             return res
         company_id = user.company.id
 
+        party_ids = [p.id for p in parties]
+        line_from = line.join(account, condition=account.id == line.account)
         line_query, _ = MoveLine.query_get(line)
-
-        for name in names:
-            code = name
-            today_query = Literal(True)
-            if name in ('receivable_today', 'payable_today'):
-                code = name[:-6]
-                today_query = ((line.maturity_date <= Date.today())
-                    | (line.maturity_date == None))
-
-            cursor.execute(*line.join(account,
-                    condition=account.id == line.account
-                    ).select(line.party,
-                    Sum(Coalesce(line.debit, 0) - Coalesce(line.credit, 0)),
+        balance_query, _ = PeriodBalance.query_get(balance)
+
+        # Compute all the kinds at once, the today amounts need the lines
+        for today in (False, True):
+            kinds = [n[:-6] if today else n for n in names
+                if n.endswith('_today') == today]
+            if not kinds:
+                continue
+            if not today and balance_query is not None:
+                source = balance
+                from_ = balance.join(account,
+                    condition=account.id == balance.account)
+                where = balance_query
+            else:
+                source = line
+                from_ = line_from
+                where = line_query & (line.reconciliation == None)
+                if today:
+                    where &= ((line.maturity_date <= Date.today())
+                        | (line.maturity_date == None))
+
+            cursor.execute(*from_.select(source.party, account.kind,
+                    Sum(Coalesce(source.debit, 0)
+                        - Coalesce(source.credit, 0)),
                     where=account.active
-                    & (account.kind == code)
-                    & line.party.in_([p.id for p in parties])
-                    & (line.reconciliation == None)
+                    & account.kind.in_(kinds)
+                    & source.party.in_(party_ids)
                     & (account.company == company_id)
-                    & line_query & today_query,
-                    group_by=line.party))
-            for party_id, sum in cursor.fetchall():
+                    & where,
+                    group_by=[source.party, account.kind]))
+            for party_id, kind, sum in cursor.fetchall():
                 # SQLite uses float for SUM
                 if not isinstance(sum, Decimal):
                     sum = Decimal(str(sum))
+                name = kind + '_today' if today else kind
                 res[name][party_id] = sum
         return res
 
@@ -124,12 +140,14 @@ class Party:
         pool = Pool()
         MoveLine = pool.get('account.move.line')
         Account = pool.get('account.account')
+        PartyBalance = pool.get('account.account.party_balance')
         Company = pool.get('company.company')
         User = pool.get('res.user')
         Date = pool.get('ir.date')
 
         line = MoveLine.__table__()
         account = Account.__table__()
+        balance = PartyBalance.__table__()
 
         if name not in ('receivable', 'payable',
                 'receivable_today', 'payable_today'):
@@ -156,26 +174,34 @@ class Party:
         if not company_id:
             return []
 
-        code = name
-        today_query = Literal(True)
+        # Only the today amounts need to be computed from the lines
         if name in ('receivable_today', 'payable_today'):
             code = name[:-6]
-            today_query = ((line.maturity_date <= Date.today())
-                | (line.maturity_date == None))
-
-        line_query, _ = MoveLine.query_get(line)
+            source = line
+            # The same lines as the ones stored in the party balances
+            where = ((line.state != 'draft')
+                & (line.reconciliation == None)
+                & ((line.maturity_date <= Date.today())
+                    | (line.maturity_date == None)))
+            if Transaction().context.get('posted'):
+                where &= line.move_state == 'posted'
+        else:
+            code = name
+            source = balance
+            where = Literal(True)
+            if Transaction().context.get('posted'):
+                where &= balance.posted
         Operator = fields.SQL_OPERATORS[clause[1]]
 
-        query = line.join(account, condition=account.id == line.account
-                ).select(line.party,
+        query = source.join(account, condition=account.id == source.account
+                ).select(source.party,
                     where=account.active
                     & (account.kind == code)
-                    & (line.party != None)
-                    & (line.reconciliation == None)
+                    & (source.party != None)
                     & (account.company == company_id)
-                    & today_query,
-                    group_by=line.party,
-                    having=Operator(Sum(Coalesce(line.debit, 0)
-                            - Coalesce(line.credit, 0)),
+                    & where,
+                    group_by=source.party,
+                    having=Operator(Sum(Coalesce(source.debit, 0)
+                            - Coalesce(source.credit, 0)),
                         Decimal(clause[2] or 0)))
         return [('id', 'in', query)]
@@ -1,5 +1,7 @@
 #This file is part of Tryton.  The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
+import zlib
+
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import Wizard, StateTransition
 from trytond.pyson import Eval
@@ -7,6 +9,9 @@ from trytond.transaction import Transaction
 from trytond.pool import Pool
 from trytond.const import OPERATORS
 from trytond import backend
+from trytond.cache import Cache
+
+from .common import find_interval, cache_get, cache_set, cache_clear
 
 __all__ = ['Period', 'ClosePeriod', 'ReOpenPeriod']
 
@@ -14,6 +19,8 @@ _STATES = {
     'readonly': Eval('state') == 'close',
 }
 _DEPENDS = ['state']
+# Namespace of the advisory locks on periods
+_LOCK_KEY = zlib.crc32('account.period') & 0x7fffffff
 
 
 class Period(ModelSQL, ModelView):
@@ -41,6 +48,7 @@ class Period(ModelSQL, ModelView):
         states=_STATES, depends=_DEPENDS, select=True)
     company = fields.Function(fields.Many2One('company.company', 'Company',),
         'get_company', searcher='search_company')
+    _find_cache = Cache('account_period.find', context=False)
 
     @classmethod
     def __register__(cls, module_name):
@@ -167,16 +175,10 @@ class Period(ModelSQL, ModelView):
 
         if not date:
             date = Date.today()
-        clause = [
-            ('start_date', '<=', date),
-            ('end_date', '>=', date),
-            ('fiscalyear.company', '=', company_id),
-            ('type', '=', 'standard'),
-            ]
-        if test_state:
-            clause.append(('state', '!=', 'close'))
-        periods = cls.search(clause, order=[('start_date', 'DESC')], limit=1)
-        if not periods:
+        period = find_interval(cls._get_find_intervals(company_id), date)
+        if period and test_state and period[3] == 'close':
+            period = None
+        if not period:
             if exception:
                 language = Transaction().language
                 languages = Lang.search([('code', '=', language)])
@@ -188,7 +190,25 @@ class Period(ModelSQL, ModelView):
                 cls.raise_user_error('no_period_date', (formatted,))
             else:
                 return None
-        return periods[0].id
+        return period[2]
+
+    @classmethod
+    def _get_find_intervals(cls, company_id):
+        '''
+        Return the sorted list of (start date, end date, id, state) of the
+        standard periods of the company used by find
+        '''
+        intervals = cache_get(cls._find_cache, company_id)
+        if intervals is None:
+            with Transaction().set_user(0):
+                periods = cls.search([
+                        ('fiscalyear.company', '=', company_id),
+                        ('type', '=', 'standard'),
+                        ], order=[('start_date', 'ASC')])
+            intervals = [(p.start_date, p.end_date, p.id, p.state)
+                for p in periods]
+            cache_set(cls._find_cache, company_id, intervals)
+        return intervals
 
     @classmethod
     def _check(cls, periods):
@@ -240,6 +260,7 @@ class Period(ModelSQL, ModelView):
                 if not vals.get('post_move_sequence'):
                     vals['post_move_sequence'] = (
                         fiscalyear.post_move_sequence.id)
+        cache_clear(cls._find_cache)
         return super(Period, cls).create(vlist)
 
     @classmethod
@@ -271,19 +292,45 @@ class Period(ModelSQL, ModelView):
                             cls.raise_user_error('change_post_move_sequence',
                                 (period.rec_name,))
             args.extend((periods, values))
+        cache_clear(cls._find_cache)
         super(Period, cls).write(*args)
 
     @classmethod
     def delete(cls, periods):
         cls._check(periods)
+        cache_clear(cls._find_cache)
         super(Period, cls).delete(periods)
 
+    @classmethod
+    def lock_periods(cls, periods, shared=False):
+        '''
+        Lock the periods until the end of the transaction.
+        Posting takes shared locks and closing an exclusive one, so moves
+        can be posted concurrently in a period but not while it is closed.
+        PostgreSQL uses advisory locks, the other backends lock the table.
+        '''
+        cursor = Transaction().cursor
+        period_ids = sorted(set(p.id for p in periods))
+        if not period_ids:
+            return
+        if backend.name() == 'postgresql':
+            # Always lock in the same order to prevent dead locks
+            func = ('pg_advisory_xact_lock_shared' if shared
+                else 'pg_advisory_xact_lock')
+            for period_id in period_ids:
+                cursor.execute('SELECT %s(%%s, %%s)' % func,
+                    (_LOCK_KEY, period_id))
+        else:
+            cls.lock()
+
     @classmethod
     def close(cls, periods):
         pool = Pool()
         JournalPeriod = pool.get('account.journal.period')
         Move = pool.get('account.move')
 
+        # Wait for the moves being posted in the periods
+        cls.lock_periods(periods)
         unposted_periods = Move.search([
                 ('period', 'in', [p.id for p in periods]),
                 ('state', '!=', 'posted'),
@@ -10,6 +10,9 @@ from trytond import backend
 from trytond.pyson import Eval, If, Bool, PYSONEncoder
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
+
+from .common import get_tree, rollup, cache_get, cache_set, cache_clear
 
 __all__ = ['TaxGroup', 'TaxCodeTemplate', 'TaxCode',
     'OpenChartTaxCodeStart', 'OpenChartTaxCode',
@@ -194,16 +197,13 @@ class TaxCode(ModelSQL, ModelView):
         tax_line = TaxLine.__table__()
         move_line = MoveLine.__table__()
 
-        childs = cls.search([
-                ('parent', 'child_of', [c.id for c in codes]),
-                ])
-        all_codes = list(set(codes) | set(childs))
+        childs = get_tree(cls, [c.id for c in codes])
+        child_ids = [c.id for c in childs if c.active]
         line_query, _ = MoveLine.query_get(move_line)
         cursor.execute(*code.join(tax_line, condition=tax_line.code == code.id
                 ).join(move_line, condition=tax_line.move_line == move_line.id
                 ).select(code.id, Sum(tax_line.amount),
-                where=code.id.in_([c.id for c in all_codes])
-                & code.active & line_query,
+                where=code.id.in_(child_ids) & line_query,
                 group_by=code.id))
         code_sum = {}
         for code_id, sum in cursor.fetchall():
@@ -212,15 +212,13 @@ class TaxCode(ModelSQL, ModelView):
                 sum = Decimal(str(sum))
             code_sum[code_id] = sum
 
+        for child in childs:
+            code_sum[child.id] = child.company.currency.round(
+                code_sum.get(child.id, Decimal('0.0')))
+        code_sum = rollup(childs, code_sum, prune_inactive=True)
+
         for code in codes:
-            res.setdefault(code.id, Decimal('0.0'))
-            childs = cls.search([
-                    ('parent', 'child_of', [code.id]),
-                    ])
-            for child in childs:
-                res[code.id] += code.company.currency.round(
-                    code_sum.get(child.id, Decimal('0.0')))
-            res[code.id] = code.company.currency.round(res[code.id])
+            res[code.id] = code.company.currency.round(code_sum[code.id])
         return res
 
     def get_rec_name(self, name):
@@ -668,6 +666,7 @@ class Tax(ModelSQL, ModelView):
             'readonly': Eval('type') == 'none',
             }, depends=['type'])
     template = fields.Many2One('account.tax.template', 'Template')
+    _compiled_cache = Cache('account_tax.compiled', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -757,15 +756,13 @@ class Tax(ModelSQL, ModelView):
     @classmethod
     def _unit_compute(cls, taxes, price_unit, date):
         res = []
-        for tax in taxes:
-            start_date = tax.start_date or datetime.date.min
-            end_date = tax.end_date or datetime.date.max
-            if not (start_date <= date <= end_date):
-                continue
-            if tax.type != 'none':
-                res.append(tax._process_tax(price_unit))
-            if len(tax.childs):
-                res.extend(cls._unit_compute(tax.childs, price_unit, date))
+        compiled = [tax_id for tax_id, start_date, end_date
+            in cls._compile(taxes) if start_date <= date <= end_date]
+        id2tax = dict((t.id, t) for t in taxes)
+        id2tax.update((t.id, t) for t in cls.browse(
+                [i for i in compiled if i not in id2tax]))
+        for tax_id in compiled:
+            res.append(id2tax[tax_id]._process_tax(price_unit))
         return res
 
     @classmethod
@@ -775,6 +772,50 @@ class Tax(ModelSQL, ModelView):
         '''
         return sorted(taxes, key=lambda t: (t.sequence, t.id))
 
+    @classmethod
+    def create(cls, vlist):
+        cache_clear(cls._compiled_cache)
+        return super(Tax, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cache_clear(cls._compiled_cache)
+        super(Tax, cls).write(*args)
+
+    @classmethod
+    def delete(cls, taxes):
+        cache_clear(cls._compiled_cache)
+        super(Tax, cls).delete(taxes)
+
+    @classmethod
+    def _compile(cls, taxes):
+        '''
+        Return the flattened list of the taxes and their childs in the order
+        of _unit_compute as tuples of (tax id, start date, end date).
+        The dates are restricted to the dates of the parents and the taxes of
+        type none are skipped.
+        '''
+        key = tuple(t.id for t in taxes)
+        compiled = cache_get(cls._compiled_cache, key)
+        if compiled is not None:
+            return compiled
+
+        def flatten(taxes, start_date, end_date):
+            for tax in taxes:
+                tax_start_date = max(start_date,
+                    tax.start_date or datetime.date.min)
+                tax_end_date = min(end_date,
+                    tax.end_date or datetime.date.max)
+                if tax.type != 'none':
+                    yield (tax.id, tax_start_date, tax_end_date)
+                if len(tax.childs):
+                    for row in flatten(tax.childs, tax_start_date,
+                            tax_end_date):
+                        yield row
+        compiled = list(flatten(taxes, datetime.date.min, datetime.date.max))
+        cache_set(cls._compiled_cache, key, compiled)
+        return compiled
+
     @classmethod
     def compute(cls, taxes, price_unit, quantity, date=None):
         '''
@@ -796,6 +837,18 @@ class Tax(ModelSQL, ModelView):
             row['amount'] *= quantity
         return res
 
+    @classmethod
+    def compute_many(cls, values):
+        '''
+        Compute taxes for a list of (taxes, price_unit, quantity, date).
+        Return for each item the list of dict as compute does.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        today = Date.today()
+        return [cls.compute(taxes, price_unit, quantity, date or today)
+            for taxes, price_unit, quantity, date in values]
+
     def update_tax(self, template2tax_code, template2account,
             template2tax=None):
         '''
@@ -1017,11 +1070,28 @@ class TaxRule(ModelSQL, ModelView):
             ])
     lines = fields.One2Many('account.tax.rule.line', 'rule', 'Lines')
     template = fields.Many2One('account.tax.rule.template', 'Template')
+    _index_cache = Cache('account_tax_rule.index', context=False)
 
     @staticmethod
     def default_kind():
         return 'both'
 
+    def _get_index(self):
+        '''
+        Return a dictionary with (group id, origin tax id) as key and the list
+        of (position, line id) of the lines as value
+        '''
+        index = cache_get(self._index_cache, self.id)
+        if index is not None:
+            return index
+        index = {}
+        for position, line in enumerate(self.lines):
+            key = (line.group.id if line.group else None,
+                line.origin_tax.id if line.origin_tax else None)
+            index.setdefault(key, []).append((position, line.id))
+        cache_set(self._index_cache, self.id, index)
+        return index
+
     def apply(self, tax, pattern):
         '''
         Apply rule on tax
@@ -1029,14 +1099,43 @@ class TaxRule(ModelSQL, ModelView):
         value.
         Return a list of the tax id to use or None
         '''
-        pattern = pattern.copy()
-        pattern['group'] = tax.group.id if tax and tax.group else None
-        pattern['origin_tax'] = tax.id if tax else None
+        return self.apply_many([tax], pattern)[0]
 
-        for line in self.lines:
-            if line.match(pattern):
-                return line.get_taxes()
-        return tax and [tax.id] or None
+    def apply_many(self, taxes, pattern):
+        '''
+        Apply rule on each tax with the same pattern
+        Return for each tax a list of the tax id to use or None
+        '''
+        RuleLine = Pool().get('account.tax.rule.line')
+        index = self._get_index()
+
+        # Only the lines with the same group and the same or any original
+        # tax can match
+        tax2candidates = []
+        line_ids = set()
+        for tax in taxes:
+            group = tax.group.id if tax and tax.group else None
+            candidates = index.get((group, None), [])
+            if tax:
+                candidates = sorted(candidates
+                    + index.get((group, tax.id), []))
+            tax2candidates.append((tax, [i for _, i in candidates]))
+            line_ids.update(i for _, i in candidates)
+        id2line = dict((l.id, l) for l in RuleLine.browse(list(line_ids)))
+
+        result = []
+        for tax, candidates in tax2candidates:
+            tax_pattern = pattern.copy()
+            tax_pattern['group'] = tax.group.id if tax and tax.group else None
+            tax_pattern['origin_tax'] = tax.id if tax else None
+            for line_id in candidates:
+                line = id2line[line_id]
+                if line.match(tax_pattern):
+                    result.append(line.get_taxes())
+                    break
+            else:
+                result.append(tax and [tax.id] or None)
+        return result
 
     def update_rule(self, template2rule=None):
         '''
@@ -1252,6 +1351,27 @@ class TaxRuleLine(ModelSQL, ModelView):
         table, _ = tables[None]
         return [table.sequence == None, table.sequence]
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Rule = pool.get('account.tax.rule')
+        cache_clear(Rule._index_cache)
+        return super(TaxRuleLine, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Rule = pool.get('account.tax.rule')
+        cache_clear(Rule._index_cache)
+        super(TaxRuleLine, cls).write(*args)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        Rule = pool.get('account.tax.rule')
+        cache_clear(Rule._index_cache)
+        super(TaxRuleLine, cls).delete(lines)
+
     def match(self, pattern):
         '''
         Match line on pattern
@@ -9,6 +9,8 @@ import trytond.tests.test_tryton
 from trytond.tests.test_tryton import test_view, test_depends, doctest_dropdb
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond import backend
 
 
 class AccountTestCase(unittest.TestCase):
@@ -19,6 +21,7 @@ class AccountTestCase(unittest.TestCase):
         self.account_template = POOL.get('account.account.template')
         self.tax_code_template = POOL.get('account.tax.code.template')
         self.tax_template = POOL.get('account.tax.code.template')
+        self.tax_code = POOL.get('account.tax.code')
         self.account = POOL.get('account.account')
         self.account_create_chart = POOL.get(
             'account.create_chart', type='wizard')
@@ -27,12 +30,24 @@ class AccountTestCase(unittest.TestCase):
         self.fiscalyear = POOL.get('account.fiscalyear')
         self.sequence = POOL.get('ir.sequence')
         self.move = POOL.get('account.move')
+        self.move_line = POOL.get('account.move.line')
+        self.period_balance = POOL.get('account.account.period_balance')
+        self.party_balance = POOL.get('account.account.party_balance')
+        self.party = POOL.get('party.party')
+        self.reconciliation = POOL.get('account.move.reconciliation')
+        self.trial_balance = POOL.get('account.trial_balance', type='report')
+        self.aged_balance = POOL.get('account.aged_balance', type='report')
+        self.general_ledger = POOL.get('account.general_ledger',
+            type='report')
+        self.date = POOL.get('ir.date')
         self.journal = POOL.get('account.journal')
         self.account_type = POOL.get('account.account.type')
         self.period = POOL.get('account.period')
         self.balance_non_deferral = POOL.get(
             'account.fiscalyear.balance_non_deferral', type='wizard')
         self.tax = POOL.get('account.tax')
+        self.tax_rule = POOL.get('account.tax.rule')
+        self.tax_rule_line = POOL.get('account.tax.rule.line')
 
     def test0005views(self):
         'Test views'
@@ -130,6 +145,68 @@ class AccountTestCase(unittest.TestCase):
             self.assertEqual(len(fiscalyear.periods), 12)
             transaction.cursor.commit()
 
+    def test0025period_find(self):
+        'Test period and fiscal year find'
+        from trytond.modules.account.common import find_interval
+        day = datetime.timedelta(1)
+        intervals = [
+            (datetime.date(2013, 1, 1), datetime.date(2013, 1, 31), 1),
+            (datetime.date(2013, 2, 1), datetime.date(2013, 2, 28), 2),
+            (datetime.date(2013, 4, 1), datetime.date(2013, 4, 30), 3),
+            ]
+        for date, result in [
+                (datetime.date(2012, 12, 31), None),
+                (datetime.date(2013, 1, 1), 1),
+                (datetime.date(2013, 1, 31), 1),
+                (datetime.date(2013, 2, 1), 2),
+                (datetime.date(2013, 3, 15), None),
+                (datetime.date(2013, 4, 30), 3),
+                (datetime.date(2013, 5, 1), None),
+                ]:
+            interval = find_interval(intervals, date)
+            self.assertEqual(interval[2] if interval else None, result)
+        self.assertEqual(find_interval([], datetime.date(2013, 1, 1)), None)
+
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            company = fiscalyear.company
+            periods = sorted(fiscalyear.periods, key=lambda p: p.start_date)
+            first, second, last = periods[0], periods[1], periods[-1]
+
+            self.assertEqual(self.fiscalyear.find(company.id,
+                    date=fiscalyear.start_date), fiscalyear.id)
+            self.assertEqual(self.fiscalyear.find(company.id,
+                    date=fiscalyear.end_date), fiscalyear.id)
+            self.assertEqual(self.fiscalyear.find(company.id,
+                    date=fiscalyear.start_date - day, exception=False), None)
+            self.assertRaises(UserError, self.fiscalyear.find, company.id,
+                date=fiscalyear.end_date + day)
+
+            self.assertEqual(self.period.find(company.id,
+                    date=first.start_date), first.id)
+            self.assertEqual(self.period.find(company.id,
+                    date=first.end_date), first.id)
+            self.assertEqual(self.period.find(company.id,
+                    date=second.start_date), second.id)
+            self.assertEqual(self.period.find(company.id,
+                    date=last.end_date), last.id)
+            self.assertEqual(self.period.find(company.id,
+                    date=first.start_date - day, exception=False), None)
+            self.assertRaises(UserError, self.period.find, company.id,
+                date=last.end_date + day)
+
+            # A closed period is found only without test_state
+            self.period.close([first])
+            self.assertEqual(self.period.find(company.id,
+                    date=first.start_date, exception=False), None)
+            self.assertEqual(self.period.find(company.id,
+                    date=first.start_date, test_state=False), first.id)
+            self.assertEqual(self.period.find(company.id,
+                    date=second.start_date), second.id)
+
+            transaction.cursor.rollback()
+
     def test0030account_debit_credit(self):
         'Test account debit/credit'
         with Transaction().start(DB_NAME, USER,
@@ -259,6 +336,11 @@ class AccountTestCase(unittest.TestCase):
             balance_non_deferral.start.credit_account = account_pl
             balance_non_deferral.start.debit_account = account_pl
 
+            balance_non_deferral.start.max_lines = 1
+            self.assertRaises(UserError, balance_non_deferral._execute,
+                'balance')
+            balance_non_deferral.start.max_lines = None
+
             balance_non_deferral._execute('balance')
 
             moves = self.move.search([
@@ -318,6 +400,639 @@ class AccountTestCase(unittest.TestCase):
 
             transaction.cursor.rollback()
 
+    def test0035move_line_move_fields(self):
+        'Test move fields stored on move lines'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period = sorted(fiscalyear.periods, key=lambda p: p.start_date)[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+
+            def check(move):
+                move = self.move(move.id)
+                for line in self.move_line.browse([l.id for l in move.lines]):
+                    self.assertEqual(
+                        (line.date, line.journal, line.period,
+                            line.move_state),
+                        (move.date, move.journal, move.period, move.state))
+
+            move, = self.move.create([{
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        }])
+            # Lines without date and lines with different dates on the same
+            # move
+            self.move_line.create([{
+                        'move': move.id,
+                        'account': revenue.id,
+                        'credit': Decimal(30),
+                        'date': period.start_date + datetime.timedelta(1),
+                        }, {
+                        'move': move.id,
+                        'account': revenue.id,
+                        'credit': Decimal(70),
+                        }, {
+                        'move': move.id,
+                        'account': receivable.id,
+                        'debit': Decimal(100),
+                        'date': period.start_date + datetime.timedelta(2),
+                        }])
+            self.assertEqual(self.move(move.id).date,
+                period.start_date + datetime.timedelta(2))
+            check(move)
+
+            self.move.write([move], {
+                    'date': period.start_date,
+                    })
+            check(move)
+
+            line = self.move(move.id).lines[0]
+            self.move_line.write([line], {
+                    'date': period.start_date + datetime.timedelta(3),
+                    })
+            self.assertEqual(self.move(move.id).date,
+                period.start_date + datetime.timedelta(3))
+            check(move)
+
+            self.move.post([move])
+            check(move)
+
+            transaction.cursor.rollback()
+
+    def test0036period_balance(self):
+        'Test account period balances'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period1, period2 = sorted(fiscalyear.periods,
+                key=lambda p: p.start_date)[:2]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            self.journal.write([journal_revenue], {
+                    'update_posted': True,
+                    })
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            expense, = self.account.search([
+                    ('kind', '=', 'expense'),
+                    ])
+
+            def check():
+                expected = {}
+                for line in self.move_line.search([
+                            ('state', '!=', 'draft'),
+                            ]):
+                    key = (line.account.id, line.move.period.id,
+                        line.move.state == 'posted')
+                    debit, credit = expected.get(key,
+                        (Decimal(0), Decimal(0)))
+                    expected[key] = (debit + line.debit,
+                        credit + line.credit)
+                balances = {}
+                for balance in self.period_balance.search([]):
+                    key = (balance.account.id, balance.period.id,
+                        bool(balance.posted))
+                    self.assertNotIn(key, balances)
+                    balances[key] = (balance.debit, balance.credit)
+                # The balances without amount are not stored
+                self.assertEqual(balances, dict((k, v)
+                        for k, v in expected.iteritems() if any(v)))
+
+            move, unbalanced = self.move.create([{
+                        'period': period1.id,
+                        'journal': journal_revenue.id,
+                        'date': period1.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': revenue.id,
+                                        'credit': Decimal(100),
+                                        }, {
+                                        'account': receivable.id,
+                                        'debit': Decimal(100),
+                                        }]),
+                            ],
+                        }, {
+                        'period': period1.id,
+                        'journal': journal_revenue.id,
+                        'date': period1.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': revenue.id,
+                                        'credit': Decimal(10),
+                                        }]),
+                            ],
+                        }])
+            check()
+            # The lines of the unbalanced move are not counted
+            self.assertEqual(len(self.period_balance.search([])), 2)
+
+            self.move.post([move])
+            check()
+
+            self.move.draft([move])
+            check()
+
+            revenue_line, receivable_line = sorted(self.move(move.id).lines,
+                key=lambda l: l.credit, reverse=True)
+            self.move_line.write([revenue_line], {
+                    'credit': Decimal(60),
+                    })
+            check()
+            self.move_line.write([receivable_line], {
+                    'account': expense.id,
+                    'debit': Decimal(60),
+                    })
+            check()
+
+            # The lines created with the new period are counted once
+            self.move.write([move], {
+                    'period': period2.id,
+                    'date': period2.start_date,
+                    'lines': [
+                        ('create', [{
+                                    'account': revenue.id,
+                                    'credit': Decimal(5),
+                                    }, {
+                                    'account': expense.id,
+                                    'debit': Decimal(5),
+                                    }]),
+                        ],
+                    })
+            check()
+
+            # The period written from a line
+            self.move_line.write([revenue_line], {
+                    'period': period1.id,
+                    'date': period1.start_date,
+                    })
+            self.assertEqual(self.move(move.id).period, period1)
+            check()
+
+            self.move_line.write([self.move(unbalanced.id).lines[0]], {
+                    'credit': Decimal(0),
+                    })
+            check()
+
+            self.move_line.delete([self.move_line(receivable_line.id)])
+            check()
+            # Only the zero line of the unbalanced move is left valid
+            self.assertEqual(self.period_balance.search([]), [])
+
+            # The differences are added to the existing balance
+            key = (revenue.id, period1.id, False)
+            for _ in range(2):
+                self.period_balance.update({}, {
+                        key: (Decimal(5), Decimal(0)),
+                        })
+            balance, = self.period_balance.search([])
+            self.assertEqual((balance.debit, balance.credit),
+                (Decimal(10), Decimal(0)))
+            self.period_balance.update({
+                    key: (Decimal(10), Decimal(0)),
+                    }, {})
+            self.assertEqual(self.period_balance.search([]), [])
+
+            transaction.cursor.rollback()
+
+    def test0037party_balance(self):
+        'Test account party balances'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period = sorted(fiscalyear.periods, key=lambda p: p.start_date)[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            party, = self.party.create([{
+                        'name': 'Party',
+                        }])
+
+            def check():
+                expected = {}
+                for line in self.move_line.search([
+                            ('state', '!=', 'draft'),
+                            ('party', '!=', None),
+                            ('reconciliation', '=', None),
+                            ]):
+                    key = (line.party.id, line.account.id,
+                        line.move.period.id, line.move.state == 'posted')
+                    debit, credit = expected.get(key,
+                        (Decimal(0), Decimal(0)))
+                    expected[key] = (debit + line.debit,
+                        credit + line.credit)
+                balances = {}
+                for balance in self.party_balance.search([]):
+                    key = (balance.party.id, balance.account.id,
+                        balance.period.id, bool(balance.posted))
+                    self.assertNotIn(key, balances)
+                    balances[key] = (balance.debit, balance.credit)
+                # The balances without amount are not stored
+                self.assertEqual(balances, dict((k, v)
+                        for k, v in expected.iteritems() if any(v)))
+
+            def check_receivable(amount, posted_amount):
+                for context, value in (
+                        ({}, amount),
+                        ({'posted': True}, posted_amount),
+                        ):
+                    with Transaction().set_context(**context):
+                        party_ = self.party(party.id)
+                        self.assertEqual(party_.receivable, value)
+                        self.assertEqual(party_.receivable_today, value)
+                        if not value:
+                            continue
+                        for name in ('receivable', 'receivable_today'):
+                            self.assertEqual(self.party.search([
+                                        (name, '=', value),
+                                        ]), [party_])
+
+            move, unbalanced = self.move.create([{
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': revenue.id,
+                                        'credit': Decimal(100),
+                                        }, {
+                                        'account': receivable.id,
+                                        'party': party.id,
+                                        'debit': Decimal(100),
+                                        }]),
+                            ],
+                        }, {
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': receivable.id,
+                                        'party': party.id,
+                                        'debit': Decimal(50),
+                                        }]),
+                            ],
+                        }])
+            check()
+            # The lines of the unbalanced move are not counted
+            check_receivable(Decimal(100), Decimal(0))
+
+            self.move.post([move])
+            check()
+            check_receivable(Decimal(100), Decimal(100))
+
+            payment, = self.move.create([{
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': revenue.id,
+                                        'debit': Decimal(100),
+                                        }, {
+                                        'account': receivable.id,
+                                        'party': party.id,
+                                        'credit': Decimal(100),
+                                        }]),
+                            ],
+                        }])
+            check()
+            check_receivable(Decimal(0), Decimal(100))
+
+            reconciliation = self.move_line.reconcile([l
+                    for m in (move, payment)
+                    for l in self.move(m.id).lines
+                    if l.account == receivable])
+            check()
+            self.assertEqual(self.party_balance.search([]), [])
+            check_receivable(Decimal(0), Decimal(0))
+
+            self.reconciliation.delete([reconciliation])
+            check()
+            check_receivable(Decimal(0), Decimal(100))
+
+            transaction.cursor.rollback()
+
+    def test0038move_import(self):
+        'Test move import by batch'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period1, period2 = sorted(fiscalyear.periods,
+                key=lambda p: p.start_date)[:2]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            view, = self.account.search([
+                    ('kind', '=', 'view'),
+                    ], limit=1)
+            party, = self.party.create([{
+                        'name': 'Party',
+                        }])
+
+            rows = [{
+                    'journal': journal_revenue.id,
+                    'period': period1.id,
+                    'date': period1.start_date,
+                    'lines': [{
+                            'account': revenue.id,
+                            'credit': Decimal(100),
+                            }, {
+                            'account': receivable.id,
+                            'party': party.id,
+                            'debit': Decimal(100),
+                            }],
+                    }, {
+                    'journal': journal_revenue.id,
+                    'date': period2.start_date,
+                    'lines': [{
+                            'account': revenue.id,
+                            'credit': Decimal(30),
+                            }, {
+                            'account': receivable.id,
+                            'party': party.id,
+                            'debit': Decimal(30),
+                            }],
+                    }, {
+                    'journal': journal_revenue.id,
+                    'date': period2.start_date,
+                    'lines': [{
+                            'account': revenue.id,
+                            'credit': Decimal(10),
+                            }],
+                    }]
+            move1, move2, unbalanced = self.move.import_batch(rows,
+                batch_size=2)
+            self.assertEqual([m.period for m in (move1, move2, unbalanced)],
+                [period1, period2, period2])
+            for move, row, state in zip([move1, move2, unbalanced], rows,
+                    ['valid', 'valid', 'draft']):
+                move = self.move(move.id)
+                self.assertEqual(len(move.lines), len(row['lines']))
+                for line in move.lines:
+                    self.assertEqual(
+                        (line.state, line.journal, line.period, line.date),
+                        (state, move.journal, move.period, move.date))
+
+            # The lines of the unbalanced move are not counted
+            revenue = self.account(revenue.id)
+            self.assertEqual((revenue.debit, revenue.credit),
+                (Decimal(0), Decimal(130)))
+            with Transaction().set_context(periods=[period2.id]):
+                revenue = self.account(revenue.id)
+                self.assertEqual((revenue.debit, revenue.credit),
+                    (Decimal(0), Decimal(30)))
+            self.assertEqual(self.party(party.id).receivable, Decimal(130))
+
+            self.move.post([move1, move2])
+            with Transaction().set_context(posted=True):
+                revenue = self.account(revenue.id)
+                self.assertEqual((revenue.debit, revenue.credit),
+                    (Decimal(0), Decimal(130)))
+
+            # Missing date, missing account, unsupported field, view
+            # account and too many digits
+            for move_values, line_values in (
+                    ({}, {'account': revenue.id}),
+                    ({'date': period1.start_date}, {}),
+                    ({'date': period1.start_date},
+                        {'account': revenue.id, 'tax_lines': []}),
+                    ({'date': period1.start_date}, {'account': view.id}),
+                    ({'date': period1.start_date},
+                        {'account': revenue.id, 'credit': Decimal('10.001')}),
+                    ({'date': period1.start_date},
+                        {'account': revenue.id, 'debit': 10.5}),
+                    ({'date': period1.start_date},
+                        {'account': revenue.id,
+                            'amount_second_currency': Decimal('1.234')}),
+                    ):
+                values = {
+                    'journal': journal_revenue.id,
+                    'lines': [line_values],
+                    }
+                values.update(move_values)
+                self.assertRaises(UserError, self.move.import_batch,
+                    [values])
+
+            transaction.cursor.rollback()
+
+    def test0038defer_move_validation(self):
+        'Test deferred move validation'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period = sorted(fiscalyear.periods, key=lambda p: p.start_date)[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+
+            def create_move(amount):
+                move, = self.move.create([{
+                            'period': period.id,
+                            'journal': journal_revenue.id,
+                            'date': period.start_date,
+                            'lines': [
+                                ('create', [{
+                                            'account': revenue.id,
+                                            'credit': amount,
+                                            }, {
+                                            'account': receivable.id,
+                                            'debit': amount,
+                                            }]),
+                                ],
+                            }])
+                return move
+
+            with self.move.defer_validation():
+                move = create_move(Decimal(100))
+                self.assertEqual([l.state for l in move.lines],
+                    ['draft', 'draft'])
+                self.assertEqual(self.period_balance.search([
+                            ('account', '=', revenue.id),
+                            ]), [])
+                line, = [l for l in move.lines if l.account == receivable]
+                self.move_line.write([line], {
+                        'debit': Decimal(80),
+                        })
+                self.assertEqual(self.move_line(line.id).state, 'draft')
+            # The moves are validated at the exit
+            move = self.move(move.id)
+            self.assertEqual([l.state for l in move.lines],
+                ['draft', 'draft'])
+            self.move_line.write([line], {
+                    'debit': Decimal(100),
+                    })
+            move = self.move(move.id)
+            self.assertEqual([l.state for l in move.lines],
+                ['valid', 'valid'])
+
+            with self.move.defer_validation():
+                move = create_move(Decimal(50))
+                # The deferred moves are validated before being posted
+                self.move.post([move])
+                move = self.move(move.id)
+                self.assertEqual(move.state, 'posted')
+                self.assertEqual([l.state for l in move.lines],
+                    ['valid', 'valid'])
+            revenue = self.account(revenue.id)
+            self.assertEqual((revenue.debit, revenue.credit),
+                (Decimal(0), Decimal(150)))
+
+            # Nothing is validated if an exception is raised
+            try:
+                with self.move.defer_validation():
+                    move = create_move(Decimal(30))
+                    raise ValueError
+            except ValueError:
+                pass
+            move = self.move(move.id)
+            self.assertEqual([l.state for l in move.lines],
+                ['draft', 'draft'])
+
+            transaction.cursor.rollback()
+
+    def test0039auto_reconcile(self):
+        'Test automatic reconciliation'
+        D = Decimal
+        self.assertEqual(self.move_line._find_subset(D(5),
+                [(1, D(5)), (2, D(3)), (3, D(2))], 2), [2, 3])
+        self.assertEqual(self.move_line._find_subset(D(10),
+                [(1, D(5)), (2, D(3)), (3, D(2))], 3), [1, 2, 3])
+        self.assertEqual(self.move_line._find_subset(D(10),
+                [(1, D(5)), (2, D(3)), (3, D(2))], 2), None)
+
+        self.assertEqual(self.move_line._match_amounts([
+                    (1, D(100)), (2, D(-100)), (3, D(50)), (4, D(-20)),
+                    (5, D(-30)), (6, D(7)), (7, D(-3)), (8, D(-4)),
+                    ], 4, 20),
+            [[1, 2], [3, 4, 5], [6, 7, 8]])
+        # The remaining lines are matched together
+        self.assertEqual([sorted(g) for g in self.move_line._match_amounts([
+                        (1, D(10)), (2, D(10)), (3, D(-5)), (4, D(-15)),
+                        ], 2, 20)],
+            [[1, 2, 3, 4]])
+        self.assertEqual(self.move_line._match_amounts([
+                    (1, D(10)), (2, D(-3)),
+                    ], 4, 20), [])
+        # The candidates are limited to the first lines of opposite sign
+        amounts = [(1, D(10)), (2, D(-1)), (3, D(-1)), (4, D(-4)),
+            (5, D(-6))]
+        self.assertEqual(self.move_line._match_amounts(amounts, 4, 2), [])
+        self.assertEqual(self.move_line._match_amounts(amounts, 4, 4),
+            [[1, 4, 5]])
+
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            # The partial indexes are created on the supported backends
+            supported = self.move_line.support_open_indexes()
+            self.assertEqual(self.move_line.open_indexes_exist(),
+                dict((n, supported)
+                    for n, _ in self.move_line._open_indexes()))
+
+            fiscalyear, = self.fiscalyear.search([])
+            period = sorted(fiscalyear.periods, key=lambda p: p.start_date)[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            party, = self.party.create([{
+                        'name': 'Party',
+                        }])
+
+            vlist = []
+            for amount, party_id in ((D(100), party.id), (D(-60), party.id),
+                    (D(-40), party.id), (D(25), None), (D(-25), None)):
+                vlist.append({
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': receivable.id,
+                                        'party': party_id,
+                                        'debit': max(amount, D(0)),
+                                        'credit': max(-amount, D(0)),
+                                        }, {
+                                        'account': revenue.id,
+                                        'debit': max(-amount, D(0)),
+                                        'credit': max(amount, D(0)),
+                                        }]),
+                            ],
+                        })
+            # The lines of unbalanced move can not be reconciled
+            vlist.append({
+                    'period': period.id,
+                    'journal': journal_revenue.id,
+                    'date': period.start_date,
+                    'lines': [
+                        ('create', [{
+                                    'account': receivable.id,
+                                    'party': party.id,
+                                    'credit': D(100),
+                                    }]),
+                        ],
+                    })
+            moves = self.move.create(vlist)
+            lines = [l for m in moves for l in m.lines
+                if l.account == receivable]
+
+            # Another partition does not reconcile the lines of the party
+            # nor the lines without party
+            index = 2 if party.id % 3 == 1 else 1
+            self.assertEqual(self.move_line.auto_reconcile(
+                    accounts=[receivable], partition=(index, 3)), [])
+
+            reconciliations = self.move_line.auto_reconcile(
+                accounts=[receivable], batch_size=1)
+            self.assertEqual(
+                sorted(sorted(l.id for l in r.lines)
+                    for r in reconciliations),
+                sorted([sorted(l.id for l in lines[:3]),
+                        sorted(l.id for l in lines[3:5])]))
+            self.assertEqual(self.move_line(lines[5].id).reconciliation,
+                None)
+
+            self.assertEqual(self.move_line.auto_reconcile(
+                    accounts=[receivable]), [])
+
+            transaction.cursor.rollback()
+
     def test0040tax_compute(self):
         'Test tax compute'
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
@@ -423,6 +1138,745 @@ class AccountTestCase(unittest.TestCase):
                         'tax': child2,
                         }])
 
+            self.assertEqual(self.tax.compute_many([
+                        ([tax], Decimal('100'), 2,
+                            today + relativedelta(days=6)),
+                        ([child2], Decimal('50'), 1, None),
+                        ([], Decimal('50'), 1, None),
+                        ]), [[{
+                            'base': Decimal('200'),
+                            'amount': Decimal('40.0'),
+                            'tax': child1,
+                            }, {
+                            'base': Decimal('200'),
+                            'amount': Decimal('20'),
+                            'tax': child2,
+                            }], [{
+                            'base': Decimal('50'),
+                            'amount': Decimal('10'),
+                            'tax': child2,
+                            }], []])
+
+            # The compiled taxes follow the changes of the tree
+            child3 = self.tax()
+            child3.name = child3.description = 'Child 3'
+            child3.type = 'percentage'
+            child3.rate = Decimal('0.1')
+            child3.invoice_account = tax_account
+            child3.credit_note_account = tax_account
+            child3.parent = tax
+            child3.save()
+            child2.type = 'none'
+            child2.save()
+            self.assertEqual(self.tax.compute([tax], Decimal('100'), 2,
+                    today + relativedelta(days=6)), [{
+                        'base': Decimal('200'),
+                        'amount': Decimal('40.0'),
+                        'tax': child1,
+                        }, {
+                        'base': Decimal('200'),
+                        'amount': Decimal('20.0'),
+                        'tax': child3,
+                        }])
+
+            child1.rate = Decimal('0.3')
+            child1.save()
+            self.assertEqual(self.tax.compute_many([
+                        ([tax], Decimal('100'), 2,
+                            today + relativedelta(days=6)),
+                        ]), [[{
+                            'base': Decimal('200'),
+                            'amount': Decimal('60.0'),
+                            'tax': child1,
+                            }, {
+                            'base': Decimal('200'),
+                            'amount': Decimal('20.0'),
+                            'tax': child3,
+                            }]])
+
+    def test0041tax_code_sum(self):
+        'Test tax code sum'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            company, = self.company.search([
+                    ('rec_name', '=', 'Dunder Mifflin'),
+                    ])
+            fiscalyear, = self.fiscalyear.search([])
+            period = fiscalyear.periods[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+
+            root, = self.tax_code.create([{
+                        'name': 'Root',
+                        'company': company.id,
+                        }])
+            inactive, child = self.tax_code.create([{
+                        'name': 'Inactive',
+                        'company': company.id,
+                        'parent': root.id,
+                        'active': False,
+                        }, {
+                        'name': 'Child',
+                        'company': company.id,
+                        'parent': root.id,
+                        }])
+            grandchild, = self.tax_code.create([{
+                        'name': 'Grandchild',
+                        'company': company.id,
+                        'parent': inactive.id,
+                        }])
+
+            self.move.create([{
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': revenue.id,
+                                        'credit': Decimal(100),
+                                        'tax_lines': [
+                                            ('create', [{
+                                                        'code': c.id,
+                                                        'amount': Decimal(a),
+                                                        }
+                                                    for c, a in (
+                                                        (root, 1),
+                                                        (inactive, 2),
+                                                        (grandchild, 4),
+                                                        (child, 8))]),
+                                            ],
+                                        }, {
+                                        'account': receivable.id,
+                                        'debit': Decimal(100),
+                                        }]),
+                            ],
+                        }])
+
+            # The subtrees of the inactive codes are not summed
+            with Transaction().set_context(fiscalyear=fiscalyear.id,
+                    active_test=False):
+                codes = self.tax_code.browse(
+                    [root.id, inactive.id, child.id, grandchild.id])
+                self.assertEqual([c.sum for c in codes],
+                    [Decimal(9), Decimal(4), Decimal(8), Decimal(4)])
+
+            transaction.cursor.rollback()
+
+    def test0045reconciliation(self):
+        'Test reconciliation'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period = sorted(fiscalyear.periods, key=lambda p: p.start_date)[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            payable, = self.account.search([
+                    ('kind', '=', 'payable'),
+                    ])
+            expense, = self.account.search([
+                    ('kind', '=', 'expense'),
+                    ])
+            journal_sequence, = self.sequence.search([
+                    ('code', '=', 'account.journal'),
+                    ])
+            journal_writeoff, = self.journal.create([{
+                        'name': 'Write-Off',
+                        'code': 'WO',
+                        'type': 'write-off',
+                        'sequence': journal_sequence.id,
+                        'credit_account': expense.id,
+                        'debit_account': expense.id,
+                        }])
+            party, = self.party.create([{
+                        'name': 'Party',
+                        }])
+
+            # Create a move per (account, amount) and return their lines
+            def create_lines(*values):
+                vlist = []
+                for account, amount in values:
+                    vlist.append({
+                            'period': period.id,
+                            'journal': journal_revenue.id,
+                            'date': period.start_date,
+                            'lines': [
+                                ('create', [{
+                                            'account': account.id,
+                                            'party': party.id,
+                                            'debit': max(amount, Decimal(0)),
+                                            'credit': max(-amount,
+                                                Decimal(0)),
+                                            }, {
+                                            'account': revenue.id,
+                                            'debit': max(-amount, Decimal(0)),
+                                            'credit': max(amount, Decimal(0)),
+                                            }]),
+                                ],
+                            })
+                return [l for m in self.move.create(vlist) for l in m.lines
+                    if l.account != revenue]
+
+            # Reconcile many groups at once with a write-off
+            group1 = create_lines((receivable, Decimal(100)),
+                (receivable, Decimal(-100)))
+            group2 = create_lines((receivable, Decimal(50)),
+                (receivable, Decimal(-45)))
+            reconciliation1, reconciliation2 = self.move_line.reconcile_many(
+                [group1, group2], journal=journal_writeoff,
+                date=period.start_date)
+            for reconciliation, group in ((reconciliation1, group1),
+                    (reconciliation2, group2)):
+                lines = reconciliation.lines
+                self.assertEqual(len(lines), len(group) + 1)
+                self.assertTrue(set(l.id for l in group)
+                    < set(l.id for l in lines))
+                self.assertEqual(sum(l.debit - l.credit for l in lines),
+                    Decimal(0))
+            writeoff, = [l for l in reconciliation2.lines
+                if l.id not in [g.id for g in group2]]
+            self.assertEqual((writeoff.debit, writeoff.credit),
+                (Decimal(0), Decimal(5)))
+            self.assertEqual(writeoff.move.journal, journal_writeoff)
+
+            # Reconcile without write-off
+            group = create_lines((receivable, Decimal(20)),
+                (receivable, Decimal(-20)))
+            reconciliation = self.move_line.reconcile(group)
+            self.assertEqual(sorted(l.id for l in reconciliation.lines),
+                sorted(l.id for l in group))
+
+            # Already reconciled
+            self.assertRaises(UserError, self.move_line.reconcile, group)
+
+            # Unbalanced lines
+            group = create_lines((receivable, Decimal(30)),
+                (receivable, Decimal(-20)))
+            self.assertRaises(UserError, self.move_line.reconcile, group)
+
+            # Lines of different accounts
+            group = create_lines((receivable, Decimal(10)),
+                (payable, Decimal(-10)))
+            self.assertRaises(UserError, self.move_line.reconcile, group)
+
+            # Lines of account without reconcile
+            group = create_lines((receivable, Decimal(10)),
+                (receivable, Decimal(-10)))
+            group = [l for g in group for l in g.move.lines
+                if l.account == revenue]
+            self.assertRaises(UserError, self.move_line.reconcile, group)
+
+            transaction.cursor.rollback()
+
+    def test0050tax_rule(self):
+        'Test tax rule apply'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company, = self.company.search([
+                    ('rec_name', '=', 'Dunder Mifflin'),
+                    ])
+            tax_account, = self.account.search([
+                    ('name', '=', 'Main Tax'),
+                    ])
+            tax1, tax2, tax3 = self.tax.create([{
+                        'name': 'Tax %s' % i,
+                        'description': 'Tax %s' % i,
+                        'type': 'percentage',
+                        'rate': Decimal('0.1'),
+                        'company': company.id,
+                        'invoice_account': tax_account.id,
+                        'credit_note_account': tax_account.id,
+                        } for i in range(3)])
+            rule, = self.tax_rule.create([{
+                        'name': 'Test',
+                        'kind': 'both',
+                        'company': company.id,
+                        'lines': [('create', [{
+                                        'sequence': 1,
+                                        'origin_tax': tax1.id,
+                                        'tax': tax2.id,
+                                        }, {
+                                        'sequence': 2,
+                                        'tax': tax3.id,
+                                        }])],
+                        }])
+            line1, line2 = sorted(rule.lines, key=lambda l: l.sequence)
+
+            self.assertEqual(rule.apply(tax1, {}), [tax2.id])
+            self.assertEqual(rule.apply_many([tax1, tax2, None], {}),
+                [[tax2.id], [tax3.id], [tax3.id]])
+
+            # The index follows the changes of the lines
+            self.tax_rule_line.write([line2], {
+                    'origin_tax': tax3.id,
+                    })
+            rule = self.tax_rule(rule.id)
+            self.assertEqual(rule.apply_many([tax1, tax2, tax3, None], {}),
+                [[tax2.id], [tax2.id], [tax3.id], None])
+
+            # The first matching line by sequence wins
+            self.tax_rule_line.create([{
+                        'rule': rule.id,
+                        'sequence': 0,
+                        'origin_tax': tax1.id,
+                        'tax': tax3.id,
+                        }])
+            rule = self.tax_rule(rule.id)
+            self.assertEqual(rule.apply_many([tax1, tax2], {}),
+                [[tax3.id], [tax2.id]])
+
+            self.tax_rule_line.delete([line1])
+            self.tax_rule_line.write([line2], {
+                    'origin_tax': None,
+                    })
+            rule = self.tax_rule(rule.id)
+            self.assertEqual(rule.apply_many([tax1, tax2], {}),
+                [[tax3.id], [tax3.id]])
+
+    def test0060move_sequence_block(self):
+        'Test move sequence numbers reserved by block'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            company, = self.company.search([
+                    ('rec_name', '=', 'Dunder Mifflin'),
+                    ])
+            sequence, = self.sequence.create([{
+                        'name': 'Block',
+                        'code': 'account.move',
+                        'company': company.id,
+                        }])
+            # Not committed so not visible to the reservation
+            self.assertEqual(self.move.get_sequence_numbers(sequence.id, 2,
+                    block_size=5), ['1', '2'])
+            transaction.cursor.commit()
+
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            self.assertEqual(self.move.get_sequence_numbers(sequence.id, 2,
+                    block_size=5), ['3', '4'])
+            # The leftover numbers of the block are used first
+            self.assertEqual(self.move.get_sequence_numbers(sequence.id, 4,
+                    block_size=5), ['5', '6', '7', '8'])
+            transaction.cursor.rollback()
+        if backend.name() == 'postgresql':
+            # The blocks are committed: 3 to 7 and 8 to 12
+            next_number = 13
+        else:
+            # The numbers were taken without block and rolled back
+            next_number = 3
+
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            # Once taken without block, the sequence is no more reserved by
+            # block in the transaction
+            self.assertEqual(self.move.get_sequence_numbers(sequence.id, 1),
+                [str(next_number)])
+            self.assertEqual(self.move.get_sequence_numbers(sequence.id, 1,
+                    block_size=5), [str(next_number + 1)])
+            transaction.cursor.rollback()
+
+    def test0065move_post_period(self):
+        'Test move post by period'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period1, period2 = sorted(fiscalyear.periods,
+                key=lambda p: p.start_date)[:2]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+
+            vlist = []
+            for period in (period1, period1, period2, period2):
+                vlist.append({
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [
+                            ('create', [{
+                                        'account': revenue.id,
+                                        'credit': Decimal(10),
+                                        }, {
+                                        'account': receivable.id,
+                                        'debit': Decimal(10),
+                                        }]),
+                            ],
+                        })
+            move1, move2, move3, move4 = self.move.create(vlist)
+            self.move.post([move4])
+
+            # The posted moves are not in the partitions
+            partitions = self.move.get_post_partitions(
+                self.move.browse([move1.id, move2.id, move3.id, move4.id]))
+            company_id = fiscalyear.company.id
+            self.assertEqual(sorted(partitions), sorted([
+                        (company_id, period1.id),
+                        (company_id, period2.id),
+                        ]))
+            self.assertEqual(sorted(m.id
+                    for m in partitions[(company_id, period1.id)]),
+                sorted([move1.id, move2.id]))
+            self.assertEqual(partitions[(company_id, period2.id)], [move3])
+
+            self.period.lock_periods([period1, period2], shared=True)
+            self.move.post(partitions[(company_id, period1.id)])
+            self.assertEqual([m.state for m in self.move.browse(
+                        [move1.id, move2.id])], ['posted', 'posted'])
+
+            # A period can not be closed with draft moves
+            self.assertRaises(UserError, self.period.close, [period2])
+
+            # The period closed after the creation of the move
+            self.period.write([period2], {
+                    'state': 'close',
+                    })
+            self.assertRaises(UserError, self.move.post,
+                partitions[(company_id, period2.id)])
+
+            transaction.cursor.rollback()
+
+    def test0070trial_balance(self):
+        'Test trial balance amounts'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            periods = sorted(fiscalyear.periods, key=lambda p: p.start_date)
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            expense, = self.account.search([
+                    ('kind', '=', 'expense'),
+                    ])
+            payable, = self.account.search([
+                    ('kind', '=', 'payable'),
+                    ])
+            accounts = self.account.search([
+                    ('company', '=', fiscalyear.company.id),
+                    ('kind', '!=', 'view'),
+                    ])
+
+            previous_sequence, = self.sequence.create([{
+                        'name': 'Previous Year',
+                        'code': 'account.move',
+                        'company': fiscalyear.company.id,
+                        }])
+            previous_fiscalyear, = self.fiscalyear.copy([fiscalyear],
+                default={
+                    'start_date': (fiscalyear.start_date
+                        - relativedelta(years=1)),
+                    'end_date': (fiscalyear.start_date
+                        - datetime.timedelta(1)),
+                    'post_move_sequence': previous_sequence.id,
+                    'periods': None,
+                    })
+            self.fiscalyear.create_period([previous_fiscalyear])
+            previous_period = sorted(previous_fiscalyear.periods,
+                key=lambda p: p.start_date)[0]
+
+            def create_move(period, debit_account, credit_account, amount,
+                    post=True):
+                move, = self.move.create([{
+                            'period': period.id,
+                            'journal': journal_revenue.id,
+                            'date': period.start_date,
+                            'lines': [
+                                ('create', [{
+                                            'account': debit_account.id,
+                                            'debit': amount,
+                                            }, {
+                                            'account': credit_account.id,
+                                            'credit': amount,
+                                            }]),
+                                ],
+                            }])
+                if post:
+                    self.move.post([move])
+
+            # Only deferral accounts to allow to close the previous year
+            create_move(previous_period, receivable, payable, Decimal(70))
+            create_move(previous_period, payable, receivable, Decimal(5),
+                post=False)
+            create_move(periods[0], receivable, revenue, Decimal(100))
+            create_move(periods[1], expense, payable, Decimal(30),
+                post=False)
+            create_move(periods[2], receivable, revenue, Decimal(10))
+
+            # The amounts computed by the accounts for the contexts
+            def get_account_amounts(start_periods, end_periods, posted,
+                    empty_account):
+                start_period_ids = [p.id for p in start_periods] or [0]
+                end_period_ids = [p.id for p in end_periods]
+                values = {}
+                for name, context, fields in (
+                        ('start', {
+                                'fiscalyear': fiscalyear.id,
+                                'periods': start_period_ids,
+                                }, ['balance']),
+                        ('in', {
+                                'fiscalyear': None,
+                                'periods': end_period_ids,
+                                }, ['debit', 'credit']),
+                        ('end', {
+                                'fiscalyear': fiscalyear.id,
+                                'periods': start_period_ids + end_period_ids,
+                                }, ['balance']),
+                        ):
+                    with Transaction().set_context(posted=posted, **context):
+                        for account in self.account.browse(accounts):
+                            for field in fields:
+                                values[(name, field, account.id)] = getattr(
+                                    account, field)
+                result = {}
+                for account in accounts:
+                    debit = values[('in', 'debit', account.id)]
+                    credit = values[('in', 'credit', account.id)]
+                    if not empty_account and not debit and not credit:
+                        continue
+                    result[account.id] = {
+                        'start_balance': values[
+                            ('start', 'balance', account.id)],
+                        'debit': debit,
+                        'credit': credit,
+                        'end_balance': values[('end', 'balance', account.id)],
+                        }
+                return result
+
+            def check():
+                for start_periods, end_periods in (
+                        (periods[:1], periods[1:3]),
+                        ([], periods),
+                        (periods[:2], periods[3:4]),
+                        ):
+                    for posted in (False, True):
+                        for empty_account in (True, False):
+                            self.assertEqual(
+                                self.trial_balance.get_amounts(accounts,
+                                    fiscalyear, start_periods, end_periods,
+                                    posted, empty_account),
+                                get_account_amounts(start_periods,
+                                    end_periods, posted, empty_account))
+
+            # Previous fiscal year open
+            check()
+            amounts = self.trial_balance.get_amounts(accounts, fiscalyear,
+                periods[:1], periods[1:3], False, False)
+            self.assertEqual(sorted(amounts), sorted([revenue.id,
+                        receivable.id, expense.id, payable.id]))
+            self.assertEqual(amounts[receivable.id], {
+                    'start_balance': Decimal(165),
+                    'debit': Decimal(10),
+                    'credit': Decimal(0),
+                    'end_balance': Decimal(175),
+                    })
+
+            # Previous fiscal year closed
+            self.move.post(self.move.search([
+                        ('period.fiscalyear', '=', previous_fiscalyear.id),
+                        ('state', '=', 'draft'),
+                        ]))
+            self.fiscalyear.close([previous_fiscalyear])
+            check()
+
+            transaction.cursor.rollback()
+
+    def test0080aged_balance(self):
+        'Test aged balance'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period = sorted(fiscalyear.periods, key=lambda p: p.start_date)[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            party1, party2 = self.party.create([{
+                        'name': 'Party 1',
+                        }, {
+                        'name': 'Party 2',
+                        }])
+            today = self.date.today()
+
+            lines = []
+            for party, amount, days in (
+                    (party1, Decimal(1), 0),
+                    # Exactly on the boundary of the second term
+                    (party1, Decimal(2), 30),
+                    (party1, Decimal(4), 31),
+                    (party1, Decimal(8), 90),
+                    (party1, Decimal(16), 200),
+                    # Not yet mature
+                    (party1, Decimal(32), -5),
+                    # Without maturity
+                    (party1, Decimal(64), None),
+                    (party2, Decimal(128), 60),
+                    ):
+                if days is None:
+                    maturity_date = None
+                else:
+                    maturity_date = today - datetime.timedelta(days)
+                lines.extend([{
+                            'account': receivable.id,
+                            'party': party.id,
+                            'debit': amount,
+                            'maturity_date': maturity_date,
+                            }, {
+                            'account': revenue.id,
+                            'credit': amount,
+                            }])
+            self.move.create([{
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date,
+                        'lines': [('create', lines)],
+                        }])
+
+            localcontext = {}
+            self.aged_balance.set_localcontext({
+                    'company': fiscalyear.company.id,
+                    'posted': False,
+                    'balance_type': 'customer',
+                    'unit': 'day',
+                    'terms': [0, 30, 60, 90],
+                    }, localcontext)
+
+            self.assertEqual(localcontext['terms'], [0, 30, 60, 90])
+            parties = dict((p['name'], p) for p in localcontext['parties'])
+            self.assertEqual(sorted(parties), ['Party 1', 'Party 2'])
+            self.assertEqual(parties['Party 1']['amounts'],
+                [Decimal(1), Decimal(6), Decimal(0), Decimal(24)])
+            self.assertEqual(parties['Party 2']['amounts'],
+                [Decimal(0), Decimal(0), Decimal(128), Decimal(0)])
+            for i, amount in enumerate(parties['Party 1']['amounts']):
+                self.assertEqual(parties['Party 1']['amount%s' % i], amount)
+            self.assertEqual(localcontext['totals'],
+                [Decimal(1), Decimal(6), Decimal(128), Decimal(24)])
+            for i, total in enumerate(localcontext['totals']):
+                self.assertEqual(localcontext['total%s' % i], total)
+                self.assertEqual(localcontext['term%s' % i],
+                    localcontext['terms'][i])
+
+            # Only posted lines
+            localcontext = {}
+            self.aged_balance.set_localcontext({
+                    'company': fiscalyear.company.id,
+                    'posted': True,
+                    'balance_type': 'customer',
+                    'unit': 'day',
+                    'term1': 0,
+                    'term2': 30,
+                    'term3': 60,
+                    }, localcontext)
+            self.assertEqual(localcontext['parties'], [])
+            self.assertEqual(localcontext['totals'], [Decimal(0)] * 3)
+
+            transaction.cursor.rollback()
+
+    def test0090general_ledger_lines(self):
+        'Test general ledger lines by batch'
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            fiscalyear, = self.fiscalyear.search([])
+            period = sorted(fiscalyear.periods, key=lambda p: p.start_date)[0]
+            journal_revenue, = self.journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            revenue, = self.account.search([
+                    ('kind', '=', 'revenue'),
+                    ])
+            receivable, = self.account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+
+            vlist = []
+            amount = Decimal(1)
+            # Many lines on the same dates with the dates not in the order
+            # of creation
+            for days in (2, 0, 0, 1, 0, 2):
+                lines = []
+                for _ in range(2):
+                    lines.extend([{
+                                'account': receivable.id,
+                                'debit': amount,
+                                }, {
+                                'account': revenue.id,
+                                'credit': amount,
+                                }])
+                    amount *= 2
+                vlist.append({
+                        'period': period.id,
+                        'journal': journal_revenue.id,
+                        'date': period.start_date + datetime.timedelta(days),
+                        'lines': [('create', lines)],
+                        })
+            # The lines of unbalanced move are not shown
+            vlist.append({
+                    'period': period.id,
+                    'journal': journal_revenue.id,
+                    'date': period.start_date,
+                    'lines': [
+                        ('create', [{
+                                    'account': receivable.id,
+                                    'credit': Decimal(1),
+                                    }]),
+                        ],
+                    })
+            moves = self.move.create(vlist)
+            self.move.post(moves[:3])
+
+            for posted in (False, True):
+                expected = []
+                balance = Decimal(0)
+                domain = [
+                    ('account', '=', receivable.id),
+                    ('state', '=', 'valid'),
+                    ]
+                if posted:
+                    domain.append(('move.state', '=', 'posted'))
+                lines = self.move_line.search(domain)
+                lines.sort(key=lambda l: (l.move.date, l.id))
+                for line in lines:
+                    balance += line.debit - line.credit
+                    expected.append((line.move.date, line.debit, line.credit,
+                            balance))
+                self.assertEqual(len(expected), 6 if posted else 12)
+
+                for batch_size in (1, 2, 5, 1000):
+                    self.assertEqual([(l['date'], l['debit'], l['credit'],
+                                    l['balance'])
+                            for l in self.general_ledger.lines(receivable.id,
+                                [period], posted, batch_size=batch_size)],
+                        expected)
+
+            transaction.cursor.rollback()
 
 def suite():
     suite = trytond.tests.test_tryton.suite()